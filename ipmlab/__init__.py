@@ -0,0 +1,3 @@
+"""Ipmlab: image portable media like a boss"""
+
+__version__ = '0.4.0'
@@ -1,8 +1,13 @@
 #! /usr/bin/env python
 
 
-"""iromlab.__main__: executed when iromlab directory is called as script."""
+"""ipmlab.__main__: executed when ipmlab directory is called as script.
+Use --headless to run without graphical user interface (see headless)."""
 
+import sys
 
-from .iromlab import main
+if '--headless' in sys.argv[1:]:
+    from .headless import main
+else:
+    from .ipmlab import main
 main()
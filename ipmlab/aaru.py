@@ -3,13 +3,130 @@
 
 import os
 import io
-import time
+import re
 import logging
 import subprocess as sub
+import xml.etree.ElementTree as ETree
 from . import config
+from . import processio
 
-def extractData(writeDirectory, imageFileBaseName):
-    """Extract data to disk image"""
+# Delimiter lines of Aaru error log. Errors are logged between the first
+# and the second delimiter line
+ERRORLOG_DELIMITER = "######################################################"
+
+# Sector numbers in error log lines (e.g. "LBA 1234", "sector 1234")
+ERRORLOG_SECTOR = re.compile(r'\b(?:LBA|sector|block)\s*[:=]?\s*(\d+)', re.IGNORECASE)
+
+# Progress lines of Aaru output (e.g. "Reading sector 1234 of 2880 (45.123 MiB/sec.)")
+READING_SECTOR = re.compile(r'Reading sector (\d+) of (\d+)')
+
+# Interval (in seconds) at which progress is reported from the size of the
+# image file, if Aaru's output doesn't contain any progress lines
+PROGRESS_INTERVAL = 1
+
+
+class sectorRanges():
+    """Collects sector numbers as a list of (first, last) ranges"""
+
+    def __init__(self):
+        """Initiate class"""
+        self.ranges = []
+
+    def add(self, first, last=None):
+        """Add sector (or range of sectors first-last)"""
+        if last is None:
+            last = first
+        if self.ranges and self.ranges[-1][0] <= first <= self.ranges[-1][1] + 1:
+            # Sectors are normally logged in ascending order, so most
+            # sectors extend the most recent range
+            self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+        else:
+            self.ranges.append((first, last))
+
+    def merged(self):
+        """Return sorted list of ranges, with overlapping and adjacent ranges merged"""
+        ranges = []
+        for first, last in sorted(self.ranges):
+            if ranges and first <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+            else:
+                ranges.append((first, last))
+        return ranges
+
+
+def formatRanges(ranges):
+    """Return string representation of sector ranges (e.g. '12-15;300')"""
+    items = []
+    for first, last in ranges:
+        if first == last:
+            items.append(str(first))
+        else:
+            items.append(str(first) + '-' + str(last))
+    return ';'.join(items)
+
+
+def parseErrorLog(errorLogFile, badSectors):
+    """Parse Aaru error log line by line, and add the sectors that are
+    mentioned in error lines to badSectors (a sectorRanges instance).
+    Returns number of error lines"""
+
+    noErrors = 0
+    noDelimiters = 0
+    with io.open(errorLogFile, "r", encoding="utf-8", errors="replace") as eLog:
+        for line in eLog:
+            line = line.strip()
+            if line == ERRORLOG_DELIMITER:
+                noDelimiters += 1
+                continue
+            if noDelimiters != 1 or line == "":
+                continue
+            noErrors += 1
+            for match in ERRORLOG_SECTOR.finditer(line):
+                badSectors.add(int(match.group(1)))
+
+    if noDelimiters < 2:
+        raise ValueError("unexpected structure of error log " + errorLogFile)
+    return noErrors
+
+
+def parseResumeFile(resumeFile, badSectors):
+    """Add bad blocks that are listed in Aaru resume file to badSectors
+    (a sectorRanges instance). The file is parsed incrementally"""
+
+    inBadBlocks = False
+    for event, elem in ETree.iterparse(resumeFile, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if tag == 'BadBlocks':
+            inBadBlocks = event == 'start'
+        elif event == 'end':
+            if inBadBlocks and tag == 'Block' and elem.text is not None:
+                badSectors.add(int(elem.text))
+            elem.clear()
+
+
+def digHoles(imageFile):
+    """Deallocate all blocks of imageFile that only contain zero bytes, so
+    it becomes a sparse file"""
+    args = ['fallocate', '--dig-holes', imageFile]
+    try:
+        p = sub.run(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False,
+                   start_new_session=True)
+    except OSError:
+        logging.warning("cannot run fallocate, image file is not made sparse")
+        return
+    if p.returncode != 0:
+        logging.warning(''.join(['fallocate exited with status ', str(p.returncode), ': ',
+                                 p.stderr.decode('utf-8', errors='replace').strip()]))
+        return
+    st = os.stat(imageFile)
+    logging.info(''.join(['sparse image file: ', str(st.st_blocks*512), ' of ',
+                          str(st.st_size), ' bytes allocated']))
+
+
+def extractData(writeDirectory, imageFileBaseName, inDevice, reporter=None):
+    """Extract data from inDevice to disk image. Aaru's output is passed to
+    the log line by line while it is running, and progress is reported to
+    reporter (a progress.progressReporter instance) if it is set"""
 
     # Image file name
     imageFile = os.path.join(writeDirectory, imageFileBaseName + '.img')
@@ -17,7 +134,10 @@ def extractData(writeDirectory, imageFileBaseName):
     # Error log file name
     errorLogFile = os.path.join(writeDirectory, imageFileBaseName + '.error.log')
 
-    # This flag defines how subprocesses are executed 
+    # Resume file name
+    resumeFile = os.path.join(writeDirectory, imageFileBaseName + '.resume.xml')
+
+    # This flag defines how subprocesses are executed
     shellFlag = False
 
     args = [config.aaruBin]
@@ -26,7 +146,7 @@ def extractData(writeDirectory, imageFileBaseName):
     args.append("--encoding")
     args.append("utf-8")
     args.append("--metadata")
-    args.append(config.inDevice)
+    args.append(inDevice)
     args.append(imageFile)
 
     # Command line as string (used for logging purposes only)
@@ -34,39 +154,98 @@ def extractData(writeDirectory, imageFileBaseName):
 
     # Unmount input device
     logging.info("unmounting input device")
-    p1 = sub.Popen(['umount', config.inDevice], stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
+    p1 = sub.Popen(['umount', inDevice], stdout=sub.PIPE, stderr=sub.PIPE, shell=False,
+                   start_new_session=True)
     out, errors = p1.communicate()
- 
-    # Run Aaru as subprocess
-    logging.info("running Aaru")
-    p2 = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=shellFlag)
-    out, errors = p2.communicate()    
 
-    errorLogExists = False
-    while not errorLogExists:
-        time.sleep(2)
-        errorLogExists = os.path.isfile(errorLogFile)
+    # Set if Aaru reports the sector it is reading
+    readingSector = []
+
+    def onStdout(line):
+        """Report progress lines, and log all other lines"""
+        line = line.strip()
+        if line == "":
+            return
+        match = READING_SECTOR.search(line)
+        if match is None:
+            logging.info(line)
+        elif reporter is not None and reporter.totalSize:
+            sector, noSectors = int(match.group(1)), int(match.group(2))
+            if noSectors > 0:
+                readingSector[:] = [sector]
+                reporter.update(reporter.totalSize * sector // noSectors)
 
-    # Read error log
-    with io.open(errorLogFile, "r", encoding="utf-8") as eLog:
-        eLogList = eLog.read().splitlines()
-    eLog.close()
+    def onStderr(line):
+        """Log error output"""
+        line = line.strip()
+        if line != "":
+            logging.warning(line)
 
-    eLogDelim = "######################################################"
+    def onInterval():
+        """Report size of image file as progress if Aaru doesn't report the
+        sector it is reading"""
+        if reporter is not None and not readingSector and os.path.isfile(imageFile):
+            reporter.update(os.path.getsize(imageFile))
 
+    # Run Aaru as subprocess. It gets its own session, so a SIGINT or
+    # SIGTERM that stops Ipmlab doesn't interrupt the current medium
+    logging.info("running Aaru")
     try:
-        if eLogList[1].strip() == eLogDelim and eLogList[2].strip() == eLogDelim:
-            readErrors = False
-        else:
+        p2 = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
+                       shell=shellFlag, bufsize=0, start_new_session=True)
+
+        # Read output of both pipes as it arrives, and process it line by line
+        processio.readStreams(p2, onStdout, onStderr, PROGRESS_INTERVAL, onInterval)
+
+        p2.wait()
+
+        exitStatus = p2.returncode
+
+    except Exception:
+        exitStatus = -99
+
+    if reporter is not None:
+        if readingSector and exitStatus == 0:
+            reporter.update(reporter.totalSize, eta=0, final=True)
+        elif os.path.isfile(imageFile):
+            reporter.update(os.path.getsize(imageFile), eta=0, final=True)
+
+    if config.sparseImages and os.path.isfile(imageFile):
+        digHoles(imageFile)
+
+    # Aaru has exited, so the error log should be there
+    badSectors = sectorRanges()
+    if processio.waitForFile(errorLogFile, config.secondsToTimeout):
+        try:
+            noErrors = parseErrorLog(errorLogFile, badSectors)
+            readErrors = noErrors != 0
+        except (OSError, ValueError) as e:
+            logging.error(str(e))
             readErrors = True
-    except:
+    else:
+        logging.error("Aaru error log " + errorLogFile + " was not written")
         readErrors = True
 
+    # Aaru lists the sectors that could not be read in its resume file
+    if os.path.isfile(resumeFile):
+        try:
+            parseResumeFile(resumeFile, badSectors)
+        except (OSError, ValueError, ETree.ParseError):
+            logging.error("error reading Aaru resume file " + resumeFile)
+
+    badSectorRanges = badSectors.merged()
+    noBadSectors = sum(last - first + 1 for first, last in badSectorRanges)
+    if noBadSectors != 0:
+        readErrors = True
+        logging.info(''.join(['Aaru: ', str(noBadSectors), ' bad sectors in ',
+                              str(len(badSectorRanges)), ' ranges']))
+
     # All results to dictionary
     dictOut = {}
     dictOut["imageFile"] = imageFile
     dictOut["cmdStr"] = cmdStr
-    dictOut["status"] = p2.returncode
+    dictOut["status"] = exitStatus
     dictOut["readErrors"] = readErrors
-  
+    dictOut["badSectorRanges"] = badSectorRanges
+
     return dictOut
@@ -0,0 +1,294 @@
+#! /usr/bin/env python3
+"""Request handler of the socket API
+
+Clients send requests as JSON objects, one per line. Each request has a
+"cmd" item, and may have an "id" item, which is copied to the response (so
+clients can match responses to requests). Each response has an "ok" item,
+and an "error" item if "ok" is false. Commands:
+
+- submit: add carrier to the queue. Items: PPN, title, volumeNo (default 1),
+  force (submit even if the carrier is already in the batch). If PPN lookup
+  is enabled the title is looked up in the catalogue (unless it is given).
+  The response contains the jobID and title
+- status: status of job with jobID, or of the batch and drives if no jobID
+  is given
+- queue: all jobs that are queued or being processed
+- cancel: cancel queued job with jobID
+- subscribe / unsubscribe: (stop) sending job and progress events to the
+  client. Events are JSON objects with an "event" item ("job" or "progress")
+
+Messages that are not JSON objects are passed to the frontend as plain PPN
+or title values (which is how earlier versions of the socket API worked).
+"""
+
+import json
+import logging
+from . import config
+from . import manifest
+from . import mdo
+
+
+def jobInfo(job, status=None):
+    """Return dictionary with properties of job. If status is set, it is
+    reported instead of the current status of job"""
+    if status is None:
+        status = job.status
+    info = {'jobID': job.jobID,
+            'PPN': job.carrierData['PPN'],
+            'title': job.carrierData['title'],
+            'volumeNo': str(job.carrierData['volumeNo']),
+            'status': status,
+            'drive': job.drive.device if job.drive is not None else None}
+    if job.progress is not None and status in ['loading', 'imaging']:
+        info['percent'] = job.progress['percent']
+        info['bytesRescued'] = job.progress['bytesRescued']
+    return info
+
+
+class requestHandler():
+    """Handles requests from socket API clients. All methods must be called
+    from the frontend thread.
+
+    The frontend must have a scheduler, a lookupPool (executor for
+    catalogue lookups) and a finalising (True once the batch is being
+    finalised) attribute, and provide the following methods:
+
+    - submitCarrier(PPN, title, volumeNo): add carrier to the queue and
+      return its job
+    - legacyMessage(message): handle message that is not a JSON request
+    """
+
+    def __init__(self, frontend, server):
+        """Initiate class"""
+        self.frontend = frontend
+        self.server = server
+        self.subscribers = set()
+        # Number of requests of each client that are still being handled
+        # (e.g. waiting for a catalogue lookup)
+        self.pending = {}
+        # Clients that closed their side of the connection, but still have
+        # pending requests
+        self.closing = set()
+        self.commands = {'submit': self.submit,
+                         'status': self.status,
+                         'queue': self.queue,
+                         'cancel': self.cancel,
+                         'subscribe': self.subscribe,
+                         'unsubscribe': self.unsubscribe}
+
+    def handle(self, clientID, message):
+        """Handle message from client (None if client closed its connection)"""
+        if message is None:
+            self.subscribers.discard(clientID)
+            if clientID in self.pending:
+                # Connection is finished after the last reply
+                self.closing.add(clientID)
+            else:
+                self.server.finish(clientID)
+            return
+        if not message.startswith('{'):
+            self.frontend.legacyMessage(message)
+            return
+        try:
+            request = json.loads(message)
+        except ValueError:
+            self.error(clientID, {}, 'invalid JSON')
+            return
+        if not isinstance(request, dict):
+            self.error(clientID, {}, 'request must be a JSON object')
+            return
+        command = self.commands.get(request.get('cmd'))
+        if command is None:
+            self.error(clientID, request, 'unknown command')
+            return
+        try:
+            command(clientID, request)
+        except Exception as e:
+            logging.error(''.join(['socket API: request ', message, ' failed: ', str(e)]))
+            self.error(clientID, request, 'internal error: ' + str(e))
+
+    def reply(self, clientID, request, **items):
+        """Send successful response to client"""
+        response = {'ok': True}
+        if 'id' in request:
+            response['id'] = request['id']
+        response.update(items)
+        self.server.send(clientID, json.dumps(response))
+
+    def error(self, clientID, request, message):
+        """Send error response to client"""
+        response = {'ok': False, 'error': message}
+        if 'id' in request:
+            response['id'] = request['id']
+        self.server.send(clientID, json.dumps(response))
+
+    def isOpen(self, clientID, request):
+        """Return True if a batch is open, and send error response otherwise"""
+        if not config.batchIsOpen or self.frontend.scheduler is None:
+            self.error(clientID, request, 'no batch is open')
+            return False
+        return True
+
+    def acceptsCarriers(self, clientID, request):
+        """Return True if carriers can be added to the batch, and send error
+        response otherwise"""
+        if not self.isOpen(clientID, request):
+            return False
+        if self.frontend.finalising:
+            self.error(clientID, request, 'batch is being finalised')
+            return False
+        return True
+
+    def submit(self, clientID, request):
+        """Handle submit command"""
+        if not self.acceptsCarriers(clientID, request):
+            return
+        PPN = str(request.get('PPN', '')).strip()
+        title = str(request.get('title', '')).strip()
+        volumeNo = str(request.get('volumeNo', '1')).strip()
+
+        try:
+            if int(volumeNo) < 1:
+                raise ValueError
+        except ValueError:
+            self.error(clientID, request, 'volumeNo must be an integer value greater than or equal to 1')
+            return
+
+        if not config.enablePPNLookup:
+            PPN = ''
+            if title == '':
+                self.error(clientID, request, 'no title')
+                return
+        elif PPN == '':
+            self.error(clientID, request, 'no PPN')
+            return
+
+        if title != '':
+            self.addCarrier(clientID, request, PPN, title, volumeNo)
+        else:
+            # Look up title in separate thread, and continue on frontend thread
+            if clientID is not None:
+                self.pending[clientID] = self.pending.get(clientID, 0) + 1
+            future = self.frontend.lookupPool.submit(mdo.lookupTitle, PPN)
+            post = self.frontend.scheduler.post
+            future.add_done_callback(lambda f: post(self.onLookupDone, clientID, request,
+                                                    PPN, volumeNo, f))
+
+    def onLookupDone(self, clientID, request, PPN, volumeNo, future):
+        """Continue submit command after title lookup"""
+        try:
+            title = future.result()
+        except Exception as e:
+            self.error(clientID, request, 'catalogue lookup failed: ' + str(e))
+        else:
+            if title is None:
+                self.error(clientID, request, 'no matching record in catalogue for PPN ' + PPN)
+            elif self.acceptsCarriers(clientID, request):
+                try:
+                    self.addCarrier(clientID, request, PPN, title, volumeNo)
+                except Exception as e:
+                    logging.error(''.join(['socket API: submitting PPN ', PPN, ' failed: ', str(e)]))
+                    self.error(clientID, request, 'internal error: ' + str(e))
+        if clientID is not None:
+            self.requestDone(clientID)
+
+    def requestDone(self, clientID):
+        """Finish connection of client that closed its side of the connection
+        once all of its requests have been answered"""
+        self.pending[clientID] -= 1
+        if self.pending[clientID] == 0:
+            del self.pending[clientID]
+            if clientID in self.closing:
+                self.closing.discard(clientID)
+                self.server.finish(clientID)
+
+    def addCarrier(self, clientID, request, PPN, title, volumeNo):
+        """Add carrier to the queue (unless it is already in batch) and reply"""
+        if not request.get('force', False):
+            duplicates = manifest.index.findCarriers(PPN, title, volumeNo)
+            if duplicates:
+                self.error(clientID, request, 'carrier already in batch (jobID ' +
+                           duplicates[-1]['jobID'] + ', ' + duplicates[-1]['status'] +
+                           '), use force to submit it again')
+                return
+        job = self.frontend.submitCarrier(PPN, title, volumeNo)
+        logging.info(''.join(['socket API: submitted job ', job.jobID]))
+        self.reply(clientID, request, jobID=job.jobID, title=title)
+
+    def status(self, clientID, request):
+        """Handle status command"""
+        jobID = request.get('jobID')
+        if jobID is None:
+            scheduler = self.frontend.scheduler
+            drives = []
+            for drive in getattr(scheduler, 'drives', []):
+                driveJob = None
+                for j in scheduler.activeJobs():
+                    if j.drive is drive and j.status in ['loading', 'imaging']:
+                        driveJob = j.jobID
+                drives.append({'device': drive.device, 'jobID': driveJob})
+            self.reply(clientID, request,
+                       batchIsOpen=config.batchIsOpen,
+                       batchFolder=config.batchFolder if config.batchIsOpen else None,
+                       queued=len(scheduler.queuedJobs()) if scheduler is not None else 0,
+                       drives=drives)
+            return
+
+        if not self.isOpen(clientID, request):
+            return
+        job = self.frontend.scheduler.findJob(jobID)
+        if job is not None:
+            self.reply(clientID, request, job=jobInfo(job))
+            return
+        indexJob = manifest.index.getJob(jobID)
+        if indexJob is None:
+            self.error(clientID, request, 'unknown jobID')
+            return
+        self.reply(clientID, request, job={'jobID': indexJob['jobID'],
+                                           'PPN': indexJob['PPN'],
+                                           'title': indexJob['title'],
+                                           'volumeNo': indexJob['volumeNo'],
+                                           'status': indexJob['status'],
+                                           'success': indexJob['success']})
+
+    def queue(self, clientID, request):
+        """Handle queue command"""
+        if not self.isOpen(clientID, request):
+            return
+        self.reply(clientID, request,
+                   jobs=[jobInfo(j) for j in self.frontend.scheduler.activeJobs()])
+
+    def cancel(self, clientID, request):
+        """Handle cancel command"""
+        if not self.isOpen(clientID, request):
+            return
+        jobID = request.get('jobID')
+        if self.frontend.scheduler.cancel(jobID):
+            self.reply(clientID, request, jobID=jobID)
+        else:
+            self.error(clientID, request, 'job is not queued')
+
+    def subscribe(self, clientID, request):
+        """Handle subscribe command"""
+        self.subscribers.add(clientID)
+        self.reply(clientID, request)
+
+    def unsubscribe(self, clientID, request):
+        """Handle unsubscribe command"""
+        self.subscribers.discard(clientID)
+        self.reply(clientID, request)
+
+    def jobUpdated(self, job, status):
+        """Send job event to subscribers"""
+        self.broadcast(dict(jobInfo(job, status), event='job'))
+
+    def progressUpdated(self, job, event):
+        """Send progress event to subscribers"""
+        self.broadcast(dict(event, event='progress'))
+
+    def broadcast(self, event):
+        """Send event to all subscribers"""
+        if self.subscribers:
+            message = json.dumps(event)
+            for clientID in self.subscribers:
+                self.server.send(clientID, message)
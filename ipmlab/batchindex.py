@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+"""Batch index: SQLite database (in WAL mode) that is kept alongside the
+batch manifest. It holds all jobs of a batch (including queued ones), which
+allows fast lookups of carriers and resuming a batch with its queue intact
+"""
+
+import os
+import csv
+import json
+import sqlite3
+import threading
+
+# File name of batch index
+INDEXFILE = 'index.sqlite'
+
+# Job states that indicate a job still needs (re-)processing after the
+# batch is reopened. Failed jobs (imaging or post-processing raised an error,
+# so there is no manifest entry) are processed again too
+UNFINISHED = ('queued', 'loading', 'imaging', 'post-processing', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seqNo INTEGER PRIMARY KEY AUTOINCREMENT,
+    jobID TEXT UNIQUE NOT NULL,
+    PPN TEXT NOT NULL,
+    volumeNo TEXT NOT NULL,
+    title TEXT NOT NULL,
+    status TEXT NOT NULL,
+    success TEXT,
+    manifestRow TEXT
+);
+CREATE INDEX IF NOT EXISTS jobsPPN ON jobs (PPN, volumeNo);
+CREATE INDEX IF NOT EXISTS jobsTitle ON jobs (title, volumeNo);
+CREATE INDEX IF NOT EXISTS jobsStatus ON jobs (status);
+"""
+
+
+class batchIndex():
+    """Batch index of one batch. Can be used from multiple threads"""
+
+    def __init__(self, batchFolder):
+        """Open index (create it if it doesn't exist)"""
+        self.indexFile = os.path.join(batchFolder, INDEXFILE)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.indexFile, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """Close index"""
+        with self.lock:
+            self.conn.close()
+
+    def isEmpty(self):
+        """Return True if index doesn't contain any jobs"""
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM jobs LIMIT 1").fetchone()
+        return row is None
+
+    def addJob(self, carrierData, status='queued'):
+        """Add job to index"""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO jobs (jobID, PPN, volumeNo, title, status) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (carrierData['jobID'], carrierData['PPN'],
+                               str(carrierData['volumeNo']), carrierData['title'], status))
+
+    def setStatus(self, jobID, status):
+        """Update status of job"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET status = ? WHERE jobID = ?",
+                              (status, jobID))
+
+    def setManifestRow(self, row):
+        """Store batch manifest row of job (first item of row is the job
+        identifier, fifth is the success status), and mark job as finished"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET status = 'finished', success = ?, manifestRow = ? "
+                              "WHERE jobID = ?",
+                              (row[4], json.dumps(row), row[0]))
+
+    def findCarriers(self, PPN, title, volumeNo):
+        """Return list of (non-cancelled, non-failed) jobs for carrier with PPN
+        (or title, if PPN is empty) and volumeNo"""
+        if PPN != "":
+            query = ("SELECT * FROM jobs WHERE PPN = ? AND volumeNo = ? "
+                     "AND status NOT IN ('cancelled', 'failed') ORDER BY seqNo")
+            args = (PPN, str(volumeNo))
+        else:
+            query = ("SELECT * FROM jobs WHERE PPN = '' AND title = ? AND volumeNo = ? "
+                     "AND status NOT IN ('cancelled', 'failed') ORDER BY seqNo")
+            args = (title, str(volumeNo))
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, args)]
+
+    def getJob(self, jobID):
+        """Return job with jobID, or None if it is not in the index"""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE jobID = ?",
+                                    (jobID,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def noJobs(self):
+        """Return number of (non-cancelled) jobs in index"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs "
+                                     "WHERE status != 'cancelled'").fetchone()[0]
+
+    def lastJob(self):
+        """Return most recently added (non-cancelled) job, or None if there
+        are no jobs"""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE status != 'cancelled' "
+                                    "ORDER BY seqNo DESC LIMIT 1").fetchone()
+        return dict(row) if row is not None else None
+
+    def unfinishedJobs(self):
+        """Return list of jobs that still need processing, in submission order.
+        Failed jobs are skipped if the same carrier was submitted again later"""
+        query = ("SELECT * FROM jobs WHERE status IN (" +
+                 ",".join("?" * len(UNFINISHED)) + ") "
+                 "AND NOT (status = 'failed' AND EXISTS (SELECT 1 FROM jobs later "
+                 "WHERE later.PPN = jobs.PPN AND later.title = jobs.title "
+                 "AND later.volumeNo = jobs.volumeNo AND later.seqNo > jobs.seqNo "
+                 "AND later.status != 'cancelled')) ORDER BY seqNo")
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, UNFINISHED)]
+
+    def importManifest(self, batchManifest):
+        """Add all carriers in existing batch manifest to index, and mark
+        jobs that have a manifest row as finished. This covers batches that
+        were created before the index existed, and jobs of which the manifest
+        row was written but the index was not updated (e.g. after a crash),
+        so these are not processed again"""
+        with open(batchManifest, "r", encoding="utf-8") as bm:
+            rows = list(csv.reader(bm))
+        with self.lock, self.conn:
+            for row in rows[1:]:
+                if len(row) < 5:
+                    continue
+                self.conn.execute("INSERT OR IGNORE INTO jobs "
+                                  "(jobID, PPN, volumeNo, title, status, success, manifestRow) "
+                                  "VALUES (?, ?, ?, ?, 'finished', ?, ?)",
+                                  (row[0], row[1], row[2], row[3], row[4], json.dumps(row)))
+                self.conn.execute("UPDATE jobs SET status = 'finished', success = ?, "
+                                  "manifestRow = ? WHERE jobID = ? AND status != 'finished'",
+                                  (row[4], json.dumps(row), row[0]))
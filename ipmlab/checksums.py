@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+"""Checksum computation for all files of a carrier
+
+Each file is read only once; all configured hash algorithms are fed from
+the same (reused) read buffer.
+"""
+
+import os
+import glob
+import errno
+import hashlib
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of read buffer
+BLOCKSIZE = 2**20
+
+# Buffer of zero bytes, used for hashing the holes of sparse files (which
+# are not read from disk)
+ZEROS = bytes(BLOCKSIZE)
+
+# Supported algorithms, and the names of their checksum files
+CHECKSUMFILES = {"sha512": "checksums.sha512",
+                 "sha256": "checksums.sha256",
+                 "md5": "checksums.md5",
+                 "blake2b": "checksums.blake2b"}
+
+
+class multiHasher():
+    """Feeds data to multiple hash objects at the same time"""
+
+    def __init__(self, algorithms):
+        """Initiate class"""
+        self.hashers = {}
+        for algorithm in algorithms:
+            self.hashers[algorithm] = hashlib.new(algorithm)
+
+    def update(self, data):
+        """Update all hash objects with data"""
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self):
+        """Return dictionary with hex digest for each algorithm"""
+        digests = {}
+        for algorithm, hasher in self.hashers.items():
+            digests[algorithm] = hasher.hexdigest()
+        return digests
+
+
+def isSparse(f):
+    """Return True if file object f has fewer blocks allocated on disk than
+    its size needs (so it contains holes)"""
+    st = os.fstat(f.fileno())
+    return st.st_blocks*512 < st.st_size
+
+
+def dataExtents(fd, start, end):
+    """Yield (start, end, isData) tuples that describe the data extents and
+    holes of file descriptor fd between start and end. The whole range is
+    reported as data if the file system can't report holes"""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield start, end, True
+        return
+    position = start
+    while position < end:
+        try:
+            dataStart = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO: no more data after position
+            yield position, end, e.errno != errno.ENXIO
+            return
+        if dataStart > position:
+            yield position, min(dataStart, end), False
+        if dataStart >= end:
+            return
+        dataEnd = min(os.lseek(fd, dataStart, os.SEEK_HOLE), end)
+        yield dataStart, dataEnd, True
+        position = dataEnd
+
+
+def hashZeros(hasher, size):
+    """Update hasher with size zero bytes"""
+    view = memoryview(ZEROS)
+    while size > 0:
+        hasher.update(view[:min(BLOCKSIZE, size)])
+        size -= BLOCKSIZE
+
+
+@functools.lru_cache(maxsize=16)
+def zeroDigests(algorithms, size):
+    """Return dictionary with hex digest of size zero bytes for each of
+    algorithms (tuple). Results are cached, so all-zero chunks of the same
+    size are hashed only once"""
+    hasher = multiHasher(algorithms)
+    hashZeros(hasher, size)
+    return hasher.hexdigests()
+
+
+def hashRange(f, hasher, view, start, end):
+    """Update hasher with data of file object f from start up to end (or
+    up to the end of the file, if that comes first), using read buffer
+    view. Holes of sparse files are not read. Returns end position"""
+    end = min(end, os.fstat(f.fileno()).st_size)
+    if isSparse(f):
+        extents = dataExtents(f.fileno(), start, end)
+    else:
+        extents = [(start, end, True)]
+    position = start
+    for extentStart, extentEnd, isData in extents:
+        if not isData:
+            hashZeros(hasher, extentEnd - extentStart)
+            position = extentEnd
+            continue
+        f.seek(extentStart)
+        position = extentStart
+        while position < extentEnd:
+            noBytes = f.readinto(view[:min(BLOCKSIZE, extentEnd - position)])
+            if not noBytes:
+                return position
+            hasher.update(view[:noBytes])
+            position += noBytes
+    return position
+
+
+class imageTailer(threading.Thread):
+    """Hashes an image file while it is being written by the imaging
+    application. Function getFinalSize must return the size of the part of
+    the image (counting from the start) that will not be changed anymore
+    by the imaging application. Only that part is hashed while imaging is
+    in progress; the remainder is hashed by finish() after imaging is done
+    """
+
+    def __init__(self, imageFile, algorithms, getFinalSize, interval=2):
+        """Initiate class"""
+        threading.Thread.__init__(self, daemon=True)
+        self.imageFile = imageFile
+        self.getFinalSize = getFinalSize
+        self.interval = interval
+        self.hasher = multiHasher(algorithms)
+        self.position = 0
+        self.buf = bytearray(BLOCKSIZE)
+        self.stopEvent = threading.Event()
+
+    def hashUpTo(self, size):
+        """Hash image data from current position up to size"""
+        if size <= self.position:
+            return
+        with open(self.imageFile, "rb", buffering=0) as f:
+            self.position = hashRange(f, self.hasher, memoryview(self.buf),
+                                      self.position, size)
+
+    def run(self):
+        """Follow image file until stopped"""
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.hashUpTo(self.getFinalSize())
+            except OSError:
+                # Image file doesn't exist (yet), try again later
+                pass
+            except (ValueError, IndexError):
+                # Map file is being rewritten by the imaging application,
+                # try again later
+                pass
+
+    def finish(self):
+        """Stop following the image file, hash the remaining data and return
+        dictionary with hex digest for each algorithm. Must only be called
+        after the imaging application has exited"""
+        self.stopEvent.set()
+        if self.is_alive():
+            self.join()
+        self.hashUpTo(os.path.getsize(self.imageFile))
+        logging.info("Inline hashing: " + str(self.position) + " bytes hashed")
+        return self.hasher.hexdigests()
+
+
+def parseAlgorithms(algorithmString):
+    """Parse comma-separated list of algorithms from config file, and
+    return list of algorithm names. Raises ValueError for unsupported
+    algorithms"""
+
+    algorithms = []
+    for item in algorithmString.split(","):
+        algorithm = item.strip().lower()
+        if algorithm == "":
+            continue
+        if algorithm not in CHECKSUMFILES:
+            raise ValueError(algorithm + " is not a supported checksum algorithm")
+        if algorithm not in algorithms:
+            algorithms.append(algorithm)
+    if not algorithms:
+        raise ValueError("no checksum algorithms defined")
+    return algorithms
+
+
+def hashFile(fileIn, algorithms, offset=0, length=None):
+    """Compute hashes of fileIn for all algorithms in a single pass,
+    and return dictionary with hex digest for each algorithm. If offset
+    and length are set, only that part of the file is hashed. Holes of
+    sparse files are not read from disk"""
+
+    hasher = multiHasher(algorithms)
+    buf = bytearray(BLOCKSIZE)
+
+    with open(fileIn, "rb", buffering=0) as f:
+        end = os.fstat(f.fileno()).st_size
+        if length is not None:
+            end = min(end, offset + length)
+        if end > offset and isSparse(f):
+            extents = list(dataExtents(f.fileno(), offset, end))
+            if len(extents) == 1 and not extents[0][2]:
+                # Part is one hole
+                return dict(zeroDigests(tuple(algorithms), end - offset))
+        hashRange(f, hasher, memoryview(buf), offset, end)
+
+    return hasher.hexdigests()
+
+
+def writeChunkFiles(fileIn, chunkSize, chunkChecksums, algorithms):
+    """Write one chunk checksum file per algorithm for fileIn, and return
+    list of written file names. ChunkChecksums is a list that contains,
+    for each chunk, a dictionary with the hex digest of each algorithm"""
+
+    chunkFiles = []
+    for algorithm in algorithms:
+        chunkFile = fileIn + ".chunks." + algorithm
+        with open(chunkFile, "w", encoding="utf-8") as fChunk:
+            fChunk.write("# chunkSize " + str(chunkSize) + '\n')
+            for i, digests in enumerate(chunkChecksums):
+                lineOut = (digests[algorithm] + " " + str(i*chunkSize) + " " +
+                           os.path.basename(fileIn) + '\n')
+                fChunk.write(lineOut)
+        chunkFiles.append(chunkFile)
+    return chunkFiles
+
+
+def writeChecksumFiles(directory, checksums, algorithms):
+    """Write one checksum file per algorithm to directory. Checksums is a
+    dictionary that contains, for each file name, a dictionary with the hex
+    digest of each algorithm. Returns True on success, False otherwise"""
+
+    try:
+        for algorithm in algorithms:
+            checksumFile = os.path.join(directory, CHECKSUMFILES[algorithm])
+            with open(checksumFile, "w", encoding="utf-8") as fChecksum:
+                for fName in checksums:
+                    lineOut = checksums[fName][algorithm] + " " + os.path.basename(fName) + '\n'
+                    fChecksum.write(lineOut)
+        wroteChecksums = True
+    except IOError:
+        logging.error("Could not write checksum file")
+        wroteChecksums = False
+
+    return wroteChecksums
+
+
+def checksumDirectory(directory, algorithms, knownChecksums=None,
+                      workers=1, chunkSize=0):
+    """Calculate checksums for all files in directory, and write one
+    checksum file per algorithm. Files in knownChecksums (dictionary with,
+    for each file base name, a dictionary with the hex digest of each
+    algorithm) are not read again. Files are hashed in parallel by a pool
+    of workers threads. If chunkSize is set, files that are larger than
+    chunkSize are also hashed per chunk (so that the chunks can be hashed in
+    parallel), and the resulting chunk checksum files are listed in the
+    checksum files next to these files. This includes files in
+    knownChecksums, of which only the chunks are read"""
+
+    # All files in directory
+    allFiles = [f for f in glob.glob(directory + "/*") if os.path.isfile(f)]
+
+    # Dictionary for storing results
+    checksums = {}
+
+    if knownChecksums is None:
+        knownChecksums = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fileFutures = {}
+            chunkFutures = {}
+            for fName in allFiles:
+                fileSize = os.path.getsize(fName)
+                if chunkSize > 0 and fileSize > chunkSize:
+                    chunkFutures[fName] = [pool.submit(hashFile, fName, algorithms,
+                                                       offset, chunkSize)
+                                           for offset in range(0, fileSize, chunkSize)]
+                if os.path.basename(fName) not in knownChecksums:
+                    fileFutures[fName] = pool.submit(hashFile, fName, algorithms)
+
+            for fName in allFiles:
+                if os.path.basename(fName) in knownChecksums:
+                    checksums[fName] = knownChecksums[os.path.basename(fName)]
+                elif fName in fileFutures:
+                    checksums[fName] = fileFutures[fName].result()
+
+            for fName in chunkFutures:
+                chunkChecksums = [future.result() for future in chunkFutures[fName]]
+                for chunkFile in writeChunkFiles(fName, chunkSize, chunkChecksums,
+                                                 algorithms):
+                    checksums[chunkFile] = hashFile(chunkFile, algorithms)
+    except IOError:
+        logging.error("Could not read or write checksums in " + directory)
+        return False
+
+    return writeChecksumFiles(directory, checksums, algorithms)
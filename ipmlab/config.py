@@ -2,25 +2,38 @@
 """Shared configuration constants"""
 
 version = ""
-inDevice = ""
+inDevices = []
 fiwalkBin = ""
+fiwalkPolicy = "always"
 aaruBin = ""
 ddrescueBin = ""
 imagingApplication = ""
 blockSize = ""
 retries = ""
+retryPasses = 2
+retryTime = 0
+retryBudgets = {}
+checksumAlgorithms = ["sha512"]
+inlineHashing = False
+sparseImages = False
+hashWorkers = 1
+treeHashChunkSize = 0
+progressLogInterval = 30
+sruCacheDir = ""
+sruCacheTTL = 168
+sruCacheSize = 50
+sruConnectTimeout = 5
+sruReadTimeout = 20
+sruRetries = 3
 rootDir = ""
 batchFolder = ""
 batchManifest = ""
-secondsToTimeout = ""
+secondsToTimeout = 20
 prefixBatch = ""
 socketHost = "127.0.0.1"
 socketPort = "65432"
 enablePPNLookup = True
 enableSocketAPI = False
-quitFlag = False
 batchIsOpen = False
 readyToStart = False
-finishedMedium = False
-processingMedium = False
 finishedBatch = False
@@ -2,153 +2,408 @@
 """Wrapper module for ddrescue"""
 
 import os
-import io 
+import io
 import time
 import logging
+import threading
+import collections
 import subprocess as sub
 from . import config
-
-def getNoReadErrors(rescueLine):
-    """parse ddrescue output line for values of readErrors, return number
-    of read errors.
-    TODO: do we really need this anymore, since we're now using the number
-    of bad blocks from the map file as an indicator?"""
-
-    lineItems = rescueLine.split(",")
-
-    for item in lineItems:
-        # Note that 'errors' item was renamed to 'read errors' between ddrescue 1.19 and 1.22
-        # This should work in either case
-        if "errors:" in item:
-            reEntry = item.split(":")
-            noReadErrors = int(reEntry[1].strip())
-
-    return noReadErrors
-
-
-def getNoBadBlocks(map):
-    """Parse ddrescue map file data and count number of bad blocks
+from . import checksums
+from . import processio
+
+# Multipliers of size units used by ddrescue (SI by default, binary with
+# --binary-prefixes)
+SIZE_UNITS = {'B': 1,
+              'kB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12, 'PB': 10**15,
+              'KiB': 2**10, 'MiB': 2**20, 'GiB': 2**30, 'TiB': 2**40, 'PiB': 2**50}
+
+# Multipliers of time units used by ddrescue
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Keys of ddrescue status fields, and corresponding progress attributes.
+# Note that some fields were renamed between ddrescue 1.19 and 1.22
+STATUS_FIELDS = {'ipos': 'ipos',
+                 'opos': 'opos',
+                 'non-tried': 'nonTried',
+                 'rescued': 'rescued',
+                 'pct rescued': 'pctRescued',
+                 'non-trimmed': 'nonTrimmed',
+                 'non-scraped': 'nonScraped',
+                 'bad-sector': 'badSector',
+                 'errsize': 'badSector',
+                 'bad areas': 'badAreas',
+                 'read errors': 'readErrors',
+                 'errors': 'readErrors',
+                 'current rate': 'currentRate',
+                 'average rate': 'averageRate',
+                 'error rate': 'errorRate',
+                 'run time': 'runTime',
+                 'remaining time': 'remainingTime',
+                 'time since last successful read': 'timeSinceLastRead'}
+
+# Block status characters in ddrescue map files, and corresponding names
+# (which match the names of the status fields)
+MAP_STATUS = {'+': 'rescued',
+              '?': 'nonTried',
+              '*': 'nonTrimmed',
+              '/': 'nonScraped',
+              '-': 'badSector'}
+
+# Data block in ddrescue map file (position and size in bytes)
+mapBlock = collections.namedtuple('mapBlock', ['pos', 'size', 'status'])
+
+
+def parseSize(value):
+    """Parse ddrescue size (e.g. '1474 kB') or rate (e.g. '7680 B/s') value,
+    and return number of bytes (per second)"""
+    items = value.replace('/s', '').split()
+    if len(items) == 1:
+        # No space between number and unit
+        number = items[0].rstrip('BkMGTPi')
+        unit = items[0][len(number):] or 'B'
+    else:
+        number, unit = items[0], items[1]
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def parseTime(value):
+    """Parse ddrescue time value (e.g. '2m  9s'), and return number of
+    seconds, or None if not available"""
+    if value in ['n/a', '']:
+        return None
+    seconds = 0
+    for item in value.split():
+        seconds += int(item[:-1]) * TIME_UNITS[item[-1]]
+    return seconds
+
+
+class ddrescueProgress():
+    """Holds the most recent values of all ddrescue status fields. Sizes are
+    in bytes, rates in bytes per second and times in seconds"""
+
+    def __init__(self):
+        """Initiate class"""
+        for attribute in STATUS_FIELDS.values():
+            setattr(self, attribute, None)
+        self.readErrors = 0
+
+    def update(self, line):
+        """Parse output line, and update all status fields that occur in it.
+        Returns True if line is a status line, False otherwise"""
+        isStatusLine = False
+        for item in line.split(","):
+            key, sep, value = item.partition(":")
+            key = key.strip()
+            value = value.strip()
+            if not sep or key not in STATUS_FIELDS:
+                continue
+            attribute = STATUS_FIELDS[key]
+            try:
+                if attribute in ['readErrors', 'badAreas']:
+                    setattr(self, attribute, int(value))
+                elif attribute == 'pctRescued':
+                    setattr(self, attribute, float(value.rstrip('%')))
+                elif attribute in ['runTime', 'remainingTime', 'timeSinceLastRead']:
+                    setattr(self, attribute, parseTime(value))
+                else:
+                    setattr(self, attribute, parseSize(value))
+                isStatusLine = True
+            except (ValueError, KeyError, IndexError):
+                # Unexpected value, ignore
+                pass
+        return isStatusLine
+
+    def summary(self):
+        """Return summary of progress as string"""
+        return ''.join(['rescued: ', str(self.rescued), ' bytes (',
+                        str(self.pctRescued), '%), read errors: ', str(self.readErrors),
+                        ', average rate: ', str(self.averageRate), ' B/s, run time: ',
+                        str(self.runTime), ' s'])
+
+
+def readMap(mapFile):
+    """Parse ddrescue map file, and yield its data blocks (mapBlock tuples
+    with position, size and status) one by one, so maps of badly damaged
+    media are never read into memory as a whole.
     This follows mapfile structure described here:
     https://www.gnu.org/software/ddrescue/manual/ddrescue_manual.html#Mapfile-structure
     """
 
-    noBadBlocks = 0
     lineNo = 0
-    for line in map:
-        line = line.strip()
-        if line.startswith('#'):
-            # Line is a comment, skip
-            pass
-        elif lineNo == 0:
-            # Line is a status line, skip but increase counter
-            lineNo += 1
-        else:
+    with io.open(mapFile, "r", encoding="utf-8") as fMap:
+        for line in fMap:
+            line = line.strip()
+            if line.startswith('#') or line == '':
+                # Line is a comment, skip
+                continue
+            if lineNo == 0:
+                # Line is a status line, skip but increase counter
+                lineNo += 1
+                continue
             # Line describes a data block
             blockItems = line.split()
-            blockStatus = blockItems[2]
-            if blockStatus != '+':
-                noBadBlocks += 1
+            yield mapBlock(int(blockItems[0], 16), int(blockItems[1], 16), blockItems[2])
             lineNo += 1
 
-    return noBadBlocks
 
+def analyseMap(blocks):
+    """Compute statistics of data blocks from ddrescue map file. Returns
+    dictionary with the number of bytes for each block status, the number
+    of bad blocks (blocks that are not finished), the number and the largest
+    of all bad extents (contiguous runs of bad blocks) in bytes, and a
+    fragmentation index (0 if all bad bytes are in one extent, approaching
+    1 if they are scattered over many small extents)"""
 
-def extractData(writeDirectory, imageFileBaseName):
-    """Extract data to disk image"""
+    mapStats = dict.fromkeys(MAP_STATUS.values(), 0)
+    noBadBlocks = 0
+    noBadExtents = 0
+    largestBadExtent = 0
+    badExtent = 0
+    badEnd = None
+
+    for block in blocks:
+        mapStats[MAP_STATUS.get(block.status, 'nonTried')] += block.size
+        if block.status == '+':
+            badExtent = 0
+            continue
+        noBadBlocks += 1
+        if block.pos != badEnd:
+            # Start of new bad extent
+            noBadExtents += 1
+            badExtent = 0
+        badExtent += block.size
+        badEnd = block.pos + block.size
+        largestBadExtent = max(largestBadExtent, badExtent)
+
+    badBytes = sum(mapStats.values()) - mapStats['rescued']
+    mapStats['noBadBlocks'] = noBadBlocks
+    mapStats['noBadExtents'] = noBadExtents
+    mapStats['largestBadExtent'] = largestBadExtent
+    if badBytes > 0:
+        mapStats['fragmentation'] = round(1 - largestBadExtent/badBytes, 4)
+    else:
+        mapStats['fragmentation'] = 0.0
+    return mapStats
+
+
+def getFinishedSize(mapFile):
+    """Parse ddrescue map file and return the size of the contiguous
+    finished ('+') area at the start of the image. Ddrescue never writes
+    to finished areas again, so this part of the image is final"""
+
+    finishedSize = 0
+    for block in readMap(mapFile):
+        if block.status != '+' or block.pos != finishedSize:
+            break
+        finishedSize += block.size
+
+    return finishedSize
+
+
+def getRetryBudget(inDevice):
+    """Return retry budget (dictionary with number of retries per pass,
+    maximum number of retry passes and maximum time of all retry passes in
+    seconds, 0 meaning no limit) of inDevice"""
+    budget = {'retries': int(config.retries),
+              'retryPasses': config.retryPasses,
+              'retryTime': config.retryTime}
+    budget.update(config.retryBudgets.get(inDevice, {}))
+    return budget
+
+
+def runPass(args, reporter=None, timeout=None):
+    """Run one ddrescue pass, and return its exit status and progress.
+    If timeout is set, ddrescue is stopped after timeout seconds (it then
+    writes its map file and exits)"""
+
+    # This flag defines how subprocesses are executed
+    shellFlag = False
 
-    # Image file name
-    imageFile = os.path.join(writeDirectory, imageFileBaseName + '.img')
+    # Progress of ddrescue, updated from its output
+    progress = ddrescueProgress()
 
-    # Map file name
-    mapFile = os.path.join(writeDirectory, imageFileBaseName + '.map')
+    # Most recent line that is not a status line. Ddrescue repeats the pass
+    # header (e.g. "Copying non-tried blocks... Pass 1 (forwards)") on every
+    # status refresh, so such lines are only logged when they change
+    lastMessage = []
 
-    # Error log file name
-    #errorLogFile = os.path.join(writeDirectory, imageFileBaseName + '.error.log')
+    def onStdout(line):
+        """Update progress from status lines, and log all other lines"""
+        line = line.strip()
+        if line == "":
+            return
+        if not progress.update(line):
+            if lastMessage != [line]:
+                lastMessage[:] = [line]
+                logging.info(line)
+        elif reporter is not None and progress.rescued is not None:
+            reporter.update(progress.rescued, None, progress.currentRate,
+                            progress.averageRate, progress.remainingTime)
+
+    def onStderr(line):
+        """Log error output"""
+        line = line.strip()
+        if line != "":
+            logging.warning(line)
 
-    # This flag defines how subprocesses are executed 
-    shellFlag = False
+    # Run ddrescue as subprocess. It gets its own session, so a SIGINT or
+    # SIGTERM that stops Ipmlab doesn't interrupt the current medium
+    timer = None
+    try:
+        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
+                      shell=shellFlag, bufsize=0, start_new_session=True)
 
-    # Number of read errors
-    noReadErrors = 0
+        if timeout is not None:
+            timer = threading.Timer(timeout, p.terminate)
+            timer.start()
 
-    # Number of bad blocks
-    noBadBlocks = 0
+        # Read output of both pipes in large chunks, and process it line by line
+        processio.readStreams(p, onStdout, onStderr)
 
-    # Arguments
-    args = [config.ddrescueBin]
-    args.append('-b')
-    args.append(str(config.blockSize))
-    args.append('-r' + str(config.retries))
-    args.append('-v')
-    args.append(config.inDevice)
-    args.append(imageFile)
-    args.append(mapFile)
-
-    # Command line as string (used for logging purposes only)
-    cmdStr = " ".join(args)
+        p.wait()
 
-    # Unmount input device
-    sub.run(['umount', config.inDevice], shell=False)
+        exitStatus = p.returncode
 
-    # Run ddrescue as subprocess
-    try:
-        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
-                      shell=shellFlag, bufsize=1, universal_newlines=True)
+    except Exception:
+        # I don't even want to to start thinking how one might end up here ...
+        exitStatus = -99
 
-        # Processing of output adapted from DDRescue-GUI by Hamish McIntyre-Bhatty:
-        # https://git.launchpad.net/ddrescue-gui/tree/DDRescue_GUI.py
+    if timer is not None:
+        timer.cancel()
 
-        line = ""
-        char = " "
+    logging.info(''.join(['ddrescue ', progress.summary()]))
+    return exitStatus, progress
 
-        # Give ddrescue plenty of time to start.
-        time.sleep(2)
 
-        # Grab information from ddrescue. (After ddrescue exits, attempt to keep reading chars until
-        # the last attempt gave an empty string)
-        while p.poll() is None or char != "":
-            char = p.stdout.read(1)
-            line += char
+def extractData(writeDirectory, imageFileBaseName, inDevice, hashAlgorithms=None,
+                reporter=None):
+    """Extract data from inDevice to disk image. A fast first pass skips the
+    scraping of bad areas; if the map file shows any damage after that, only
+    the remaining areas are retried in further passes (alternately in reverse
+    direction), within the retry budget of inDevice. If hashAlgorithms is set,
+    the image is hashed while ddrescue is writing it, and the result
+    includes the digests of the image file. Progress is reported to
+    reporter (a progress.progressReporter instance) if it is set"""
 
-            # If this is the end of the line, process it, and send the results to the logger
-            if char == "\n":
-                tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
+    # Image file name
+    imageFile = os.path.join(writeDirectory, imageFileBaseName + '.img')
 
-                if tidy_line != "":
+    # Map file name
+    mapFile = os.path.join(writeDirectory, imageFileBaseName + '.map')
 
-                    if "errors:" in tidy_line:
-                        # Parse this line for value of read errors
-                        noReadErrors = getNoReadErrors(tidy_line)
+    # Error log file name
+    #errorLogFile = os.path.join(writeDirectory, imageFileBaseName + '.error.log')
 
-                # Reset line.
-                line = ""
+    budget = getRetryBudget(inDevice)
 
-        # Parse any remaining lines afterwards.
-        if line != "":
-            tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
-            if "errors:" in tidy_line:
-                # Parse this line for value of read errors
-                noReadErrors = getNoReadErrors(tidy_line)
+    # Arguments of first pass (no scraping)
+    args = [config.ddrescueBin]
+    args.append('-b')
+    args.append(str(config.blockSize))
+    args.append('-n')
+    if config.sparseImages:
+        args.append('--sparse')
+    args.append('-v')
+    args.append(inDevice)
+    args.append(imageFile)
+    args.append(mapFile)
 
-            logging.info(tidy_line)
+    # Command lines as strings (used for logging purposes only)
+    cmdStrs = [" ".join(args)]
 
-        p.wait()
+    # Unmount input device
+    sub.run(['umount', inDevice], shell=False, start_new_session=True)
 
-        exitStatus = p.returncode
+    # Start hashing the image while it is being written
+    if hashAlgorithms:
+        tailer = checksums.imageTailer(imageFile, hashAlgorithms,
+                                       lambda: getFinishedSize(mapFile))
+        tailer.start()
 
-    except Exception:
-        # I don't even want to to start thinking how one might end up here ...
-        exitStatus = -99
+    logging.info('ddrescue pass 1 (no scraping)')
+    exitStatus, progress = runPass(args, reporter)
+    noReadErrors = progress.readErrors
 
     try:
-        with io.open(mapFile, "r", encoding="utf-8") as fMap:
-            map = fMap.read().splitlines()
-            noBadBlocks = getNoBadBlocks(map)
+        mapStats = analyseMap(readMap(mapFile))
     except Exception:
         logging.error("error reading ddrescue map file")
+        mapStats = None
+
+    # Retry passes, only if the map shows bad areas
+    startTime = time.time()
+    noPass = 1
+    while (exitStatus == 0 and mapStats is not None and mapStats['noBadBlocks'] != 0 and
+           noPass <= budget['retryPasses']):
+        timeout = None
+        if budget['retryTime'] > 0:
+            timeout = budget['retryTime'] - (time.time() - startTime)
+            if timeout <= 0:
+                logging.info('ddrescue retry time budget exhausted')
+                break
+
+        args = [config.ddrescueBin]
+        args.append('-b')
+        args.append(str(config.blockSize))
+        args.append('-r' + str(budget['retries']))
+        if noPass % 2 == 0:
+            # Read in reverse direction
+            args.append('-R')
+        if config.sparseImages:
+            args.append('--sparse')
+        args.append('-v')
+        args.append(inDevice)
+        args.append(imageFile)
+        args.append(mapFile)
+        cmdStrs.append(" ".join(args))
+
+        noPass += 1
+        logging.info(''.join(['ddrescue pass ', str(noPass), ' (retrying ',
+                              str(mapStats['noBadExtents']), ' bad extents',
+                              ', reverse' if '-R' in args else '', ')']))
+        passStatus, progress = runPass(args, reporter, timeout)
+        noReadErrors += progress.readErrors
+        rescuedBefore = mapStats['rescued']
+
+        try:
+            mapStats = analyseMap(readMap(mapFile))
+        except Exception:
+            logging.error("error reading ddrescue map file")
+            mapStats = None
+            break
+
+        if timeout is not None and time.time() - startTime >= budget['retryTime']:
+            # Pass was stopped because the time budget was exhausted
+            logging.info('ddrescue retry time budget exhausted')
+            break
+        exitStatus = passStatus
+        if mapStats['rescued'] == rescuedBefore:
+            logging.info('ddrescue pass did not rescue any more data, no more retries')
+            break
+
+    if reporter is not None and progress.rescued is not None:
+        reporter.update(progress.rescued, None, progress.currentRate,
+                        progress.averageRate, 0, final=True)
+
+    if mapStats is not None:
+        noBadBlocks = mapStats['noBadBlocks']
+        logging.info(''.join(['ddrescue map: ', str(mapStats['noBadExtents']),
+                              ' bad extents, largest bad extent: ',
+                              str(mapStats['largestBadExtent']), ' bytes, fragmentation: ',
+                              str(mapStats['fragmentation'])]))
+    else:
         # Set noBadBlocks to ensure this will be flagged
         noBadBlocks = 99
 
+    # Hash the remaining (not yet hashed) part of the image
+    imageDigests = None
+    if hashAlgorithms:
+        try:
+            imageDigests = tailer.finish()
+        except OSError:
+            logging.error("error hashing image file")
+
     # Set readErrors and badBlocks flags
     readErrors = noReadErrors != 0
     badBlocks = noBadBlocks != 0
@@ -156,9 +411,13 @@ def extractData(writeDirectory, imageFileBaseName):
     # All results to dictionary
     dictOut = {}
     dictOut["imageFile"] = imageFile
-    dictOut["cmdStr"] = cmdStr
+    dictOut["cmdStr"] = "; ".join(cmdStrs)
     dictOut["status"] = exitStatus
     dictOut["readErrors"] = readErrors
     dictOut["badBlocks"] = badBlocks
+    dictOut["imageDigests"] = imageDigests
+    dictOut["mapStatistics"] = mapStats
+    dictOut["noPasses"] = noPass
+    dictOut["progress"] = progress
   
     return dictOut
@@ -0,0 +1,37 @@
+#! /usr/bin/env python3
+"""State of the input devices that are used for imaging"""
+
+import os
+
+
+class drive():
+    """Holds the state of one input device. Each drive is processed by
+    its own worker thread (see scheduler)"""
+
+    def __init__(self, device):
+        """Initiate class"""
+        self.device = device
+        self.thread = None
+
+    def hasMedium(self):
+        """Return True if a medium is loaded in this drive"""
+        try:
+            fd = os.open(self.device, os.O_RDONLY)
+            os.close(fd)
+            return True
+        except(PermissionError, OSError):
+            return False
+
+
+def parseDevices(deviceStrings):
+    """Parse list of inDevice values from config file (each of which
+    may contain multiple comma-separated devices), and return list of
+    unique device paths"""
+
+    devices = []
+    for deviceString in deviceStrings:
+        for item in deviceString.split(","):
+            device = item.strip()
+            if device != "" and device not in devices:
+                devices.append(device)
+    return devices
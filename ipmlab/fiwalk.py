@@ -2,9 +2,10 @@
 """Wrapper module for fiwalk"""
 
 import os
-import time
+import logging
 import subprocess as sub
 from . import config
+from . import processio
 
 def runFiwalk(writeDirectory, imageFileBaseName):
     """Run fiwalk on disk image and write result to dfxml"""
@@ -26,14 +27,14 @@ def runFiwalk(writeDirectory, imageFileBaseName):
 
     # Run fiwalk as subprocess
     try:        
-        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
+        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False,
+                      start_new_session=True)
         out, errors = p.communicate()
-        # Wait until output file has been written (do we really need this here?)
-        outFileExists = False
-        while not outFileExists:
-            time.sleep(2)
-            outFileExists = os.path.isfile(outFile)
         exitStatus = p.returncode
+        # Fiwalk has exited, so the output file should be there
+        if exitStatus == 0 and not processio.waitForFile(outFile, config.secondsToTimeout):
+            logging.error("fiwalk output file " + outFile + " was not written")
+            exitStatus = -99
     except Exception:
         exitStatus = -99
 
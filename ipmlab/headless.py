@@ -0,0 +1,427 @@
+#! /usr/bin/env python3
+"""Headless frontend: runs Ipmlab without graphical user interface (and
+without importing Tkinter), e.g. on imaging nodes without a display.
+
+Carriers are submitted through the socket API (see api), or as pick lists
+(see picklist) that are dropped into a watch folder. Media are not loaded
+by an operator who confirms a dialog: each worker waits until its drive
+reports a medium, and after imaging until the medium is removed again
+(e.g. by an autoloader). All output is logged to stdout and to the batch log.
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import signal
+import logging
+import threading
+import argparse
+import selectors
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from . import __version__
+from . import config
+from . import settings
+from . import manifest
+from . import drives
+from . import scheduler
+from . import picklist
+from . import api
+from .socketserver import server, messageQueue
+
+# Interval (in seconds) at which scheduler callbacks are run
+POLL_INTERVAL = 0.1
+
+# Interval (in seconds) at which drives are checked for media
+MEDIUM_INTERVAL = 1
+
+# Interval (in seconds) at which the watch folder is scanned. Files are only
+# picked up if they were not modified during the last interval
+WATCH_INTERVAL = 5
+
+# Extensions of pick lists in watch folder
+PICKLIST_EXTENSIONS = ('.csv', '.txt')
+
+# Format of log messages
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class headless():
+    """Headless frontend of scheduler and socket API"""
+
+    def __init__(self, watchFolder=None):
+        """Initiate class"""
+        self.drives = [drives.drive(inDevice) for inDevice in config.inDevices]
+        self.scheduler = None
+        # Catalogue lookups run in separate threads
+        self.lookupPool = ThreadPoolExecutor(max_workers=2)
+        self.server = None
+        self.api = None
+        self.socketQueue = None
+        self.t2 = None
+        self.watchFolder = watchFolder
+        # Pick lists in watch folder that are being imported
+        self.watchPending = set()
+        self.nextScan = 0
+        # Set by --finalise
+        self.finaliseRequested = False
+        # Set once all input has been queued, and the batch is finalised as
+        # soon as the scheduler is idle (socket API refuses new carriers)
+        self.finalising = False
+        # Most recent plain text message from socket API, and its volume number
+        self.lastMessage = None
+        # Jobs that were waiting for a medium when stopping (these are
+        # re-queued when the batch is opened again)
+        self.interrupted = []
+        self.stopRequested = False
+        self.stopping = False
+        self.stopped = False
+
+    def createBatch(self):
+        """Create new batch in rootDir"""
+        # Create unique batch identifier (UUID, based on host ID and current time)
+        batchID = str(uuid.uuid1())
+        batchName = config.prefixBatch + '-' + batchID
+        config.batchFolder = os.path.join(config.rootDir, batchName)
+        os.makedirs(config.batchFolder)
+
+        # Write Ipmlab version to file in batch
+        versionFile = os.path.join(config.batchFolder, 'version.txt')
+        with open(versionFile, "w") as vf:
+            vf.write(config.version + '\n')
+
+        self.setupLogger()
+        logging.info(''.join(['batchFolder set to ', config.batchFolder]))
+        manifest.openBatch(config.batchFolder)
+        self.startBatch()
+
+    def openBatch(self, batchFolder):
+        """Open existing batch, and re-queue its unfinished jobs"""
+        config.batchFolder = os.path.normpath(batchFolder)
+        if os.path.isfile(os.path.join(config.batchFolder, 'eob.txt')):
+            raise OSError('cannot open finalized batch ' + config.batchFolder)
+        if not os.path.isdir(config.batchFolder):
+            raise OSError('batch folder ' + config.batchFolder + ' does not exist')
+
+        self.setupLogger()
+        logging.info(''.join(['*** Opening existing batch ', config.batchFolder, ' ***']))
+        manifest.openBatch(config.batchFolder)
+        self.startBatch()
+
+        unfinishedJobs = manifest.index.unfinishedJobs()
+        logging.info(''.join(['re-queueing ', str(len(unfinishedJobs)), ' unfinished carriers']))
+        for unfinishedJob in unfinishedJobs:
+            carrierData = {}
+            carrierData['jobID'] = unfinishedJob['jobID']
+            carrierData['PPN'] = unfinishedJob['PPN']
+            carrierData['title'] = unfinishedJob['title']
+            carrierData['volumeNo'] = unfinishedJob['volumeNo']
+            manifest.index.setStatus(carrierData['jobID'], 'queued')
+            self.scheduler.submit(scheduler.job(carrierData))
+
+    def startBatch(self):
+        """Start scheduler with one worker for each drive"""
+        config.batchIsOpen = True
+        config.readyToStart = True
+        self.scheduler = scheduler.scheduler(self.drives, self)
+        self.scheduler.start()
+
+    def setupLogger(self):
+        """Add batch log to logging handlers"""
+        logFile = os.path.join(config.batchFolder, 'batch.log')
+        handler = logging.FileHandler(logFile, 'a', 'utf-8')
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logging.getLogger().addHandler(handler)
+
+    def startSocketAPI(self):
+        """Start socket API as separate thread"""
+        self.socketQueue = messageQueue()
+        self.server = server()
+        self.api = api.requestHandler(self, self.server)
+        self.t2 = threading.Thread(target=self.server.start,
+                                   args=[config.socketHost,
+                                         config.socketPort,
+                                         self.socketQueue],
+                                   name='socketAPI')
+        self.t2.start()
+
+    def finaliseWhenIdle(self):
+        """Finalise batch and stop once all queued media have been processed.
+        With a watch folder this only takes effect after its pick lists have
+        been imported (see armFinalise)"""
+        self.finaliseRequested = True
+        if self.watchFolder is None:
+            self.armFinalise()
+
+    def armFinalise(self):
+        """Wait for the scheduler to become idle if finalising was requested,
+        and no pick lists in the watch folder are waiting to be imported"""
+        if not self.finaliseRequested or self.finalising or self.stopping:
+            return
+        if self.watchFolder is not None and (self.watchPending or self.pickListFiles()):
+            return
+        self.finalising = True
+        self.scheduler.whenIdle(self.onIdle)
+
+    def onIdle(self):
+        """Stop workers after all queued media have been processed"""
+        if self.stopping:
+            return
+        if self.watchFolder is not None and (self.watchPending or self.pickListFiles()):
+            # New pick lists arrived, armed again after they are imported
+            self.finalising = False
+            return
+        logging.info('all queued carriers processed, finalising batch')
+        self.stopping = True
+        self.scheduler.shutdown(self.onFinalised)
+
+    def onFinalised(self):
+        """Write end of batch file after all workers have stopped"""
+        with open(os.path.join(config.batchFolder, 'eob.txt'), "w", encoding="utf-8") as fJob:
+            fJob.write('EOB\n')
+        config.finishedBatch = True
+        self.onStopped()
+
+    def stop(self):
+        """Stop once the media that are currently being processed have
+        finished (batch can be resumed by opening it again)"""
+        if self.stopping:
+            return
+        self.stopping = True
+        logging.info('stopping after current media have been processed')
+        if self.scheduler is not None:
+            self.scheduler.shutdown(self.onStopped)
+        else:
+            self.onStopped()
+
+    def onStopped(self):
+        """Close batch after all workers have stopped, and leave main loop"""
+        config.batchIsOpen = False
+        config.readyToStart = False
+        for jobID in self.interrupted:
+            manifest.index.setStatus(jobID, 'queued')
+        manifest.closeBatch()
+        self.stopped = True
+
+    def run(self):
+        """Main loop: handle socket API requests, scheduler callbacks and
+        the watch folder until stopped"""
+        sel = selectors.DefaultSelector()
+        if self.socketQueue is not None:
+            sel.register(self.socketQueue, selectors.EVENT_READ)
+
+        while not self.stopped:
+            if self.stopRequested:
+                self.stopRequested = False
+                self.stop()
+            sel.select(timeout=POLL_INTERVAL)
+            if self.socketQueue is not None:
+                self.handleSocketRequests()
+            self.scheduler.runCallbacks()
+            if self.watchFolder is not None and not self.stopping and time.time() >= self.nextScan:
+                self.nextScan = time.time() + WATCH_INTERVAL
+                self.scanWatchFolder()
+                self.armFinalise()
+
+        sel.close()
+        if self.server is not None:
+            self.server.stop()
+            self.t2.join(timeout=config.secondsToTimeout)
+            self.socketQueue.close()
+        self.lookupPool.shutdown(wait=False)
+        logging.info('ipmlab stopped')
+
+    def handleSocketRequests(self):
+        """Handle all pending requests from socket interface"""
+        self.socketQueue.clearNotifications()
+        while True:
+            try:
+                clientID, message = self.socketQueue.get_nowait()
+            except queue.Empty:
+                break
+            self.api.handle(clientID, message)
+
+    def scanWatchFolder(self):
+        """Import new pick lists in watch folder. Imported pick lists are moved
+        to the 'done' subfolder, and pick lists that cannot be imported to the
+        'failed' subfolder"""
+        now = time.time()
+        for entry in self.pickListFiles():
+            if entry.path in self.watchPending or now - entry.stat().st_mtime < WATCH_INTERVAL:
+                continue
+            logging.info(''.join(['importing pick list ', entry.path]))
+            try:
+                carriers = picklist.readPickList(entry.path, config.enablePPNLookup)
+            except (OSError, ValueError) as e:
+                logging.error(''.join(['cannot read pick list ', entry.path, ': ', str(e)]))
+                self.moveWatchFile(entry.path, 'failed')
+                continue
+            self.watchPending.add(entry.path)
+            future = self.lookupPool.submit(picklist.resolvePickList, carriers)
+            post = self.scheduler.post
+            future.add_done_callback(lambda f, path=entry.path: post(self.onPickListResolved, path, f))
+
+    def pickListFiles(self):
+        """Return sorted list of pick list files (os.DirEntry) in watch folder"""
+        return sorted([entry for entry in os.scandir(self.watchFolder)
+                       if entry.is_file() and not entry.name.startswith('.') and
+                       entry.name.lower().endswith(PICKLIST_EXTENSIONS)],
+                      key=lambda e: e.name)
+
+    def onPickListResolved(self, path, future):
+        """Add carriers of resolved pick list to the queue"""
+        self.watchPending.discard(path)
+        try:
+            resolved, unresolved = future.result()
+        except Exception as e:
+            # Pick list is tried again on next scan
+            logging.error(''.join(['catalogue lookup of pick list ', path, ' failed: ', str(e)]))
+            return
+        if self.stopping:
+            return
+        for PPN in unresolved:
+            logging.warning(''.join(['no catalogue record found for PPN ', PPN]))
+        noAdded = 0
+        for carrier in resolved:
+            if manifest.index.findCarriers(carrier['PPN'], carrier['title'], carrier['volumeNo']):
+                logging.warning(''.join(['skipping carrier ', carrier['PPN'], ' ', carrier['title'],
+                                         ', volume ', carrier['volumeNo'], ': already in batch']))
+                continue
+            self.submitCarrier(carrier['PPN'], carrier['title'], carrier['volumeNo'])
+            noAdded += 1
+        logging.info(''.join(['added ', str(noAdded), ' carriers from pick list ', path]))
+        self.moveWatchFile(path, 'done' if not unresolved else 'failed')
+
+    def moveWatchFile(self, path, subFolder):
+        """Move file from watch folder to subfolder"""
+        targetDir = os.path.join(self.watchFolder, subFolder)
+        try:
+            os.makedirs(targetDir, exist_ok=True)
+            shutil.move(path, os.path.join(targetDir, os.path.basename(path)))
+        except OSError as e:
+            logging.error(''.join(['cannot move ', path, ' to ', targetDir, ': ', str(e)]))
+
+    def submitCarrier(self, PPN, title, volumeNo):
+        """Add carrier to the queue, and return its job"""
+        carrierData = {}
+        carrierData['jobID'] = str(uuid.uuid1())
+        carrierData['PPN'] = PPN
+        carrierData['title'] = title
+        carrierData['volumeNo'] = volumeNo
+        logging.info(''.join(['queued job ', carrierData['jobID'], ': ', PPN, ' ',
+                              title, ', volume ', volumeNo]))
+        return self.scheduler.submit(scheduler.job(carrierData))
+
+    def legacyMessage(self, message):
+        """Submit plain text message (PPN or title) from socket interface. If
+        the same value is sent repeatedly, the volume number is increased"""
+        if self.lastMessage is not None and self.lastMessage[0] == message:
+            volumeNo = str(int(self.lastMessage[1]) + 1)
+        else:
+            volumeNo = '1'
+        self.lastMessage = (message, volumeNo)
+        request = {'cmd': 'submit', 'volumeNo': volumeNo}
+        if config.enablePPNLookup:
+            request['PPN'] = message
+        else:
+            request['title'] = message
+        # No reply is sent for plain text messages
+        self.api.submit(None, request)
+
+    def loadMedium(self, job):
+        """Wait until medium is loaded into drive (called from worker thread)"""
+        carrierData = job.carrierData
+        logging.info(''.join(['waiting for medium (', carrierData['title'], ', volume ',
+                              str(carrierData['volumeNo']), ') in drive ', job.drive.device]))
+        while not job.drive.hasMedium():
+            if self.stopping:
+                self.interrupted.append(job.jobID)
+                return False
+            time.sleep(MEDIUM_INTERVAL)
+        return True
+
+    def removeMedium(self, job):
+        """Wait until medium is removed from drive (called from worker thread)"""
+        logging.info(''.join(['waiting for removal of medium from drive ', job.drive.device]))
+        while job.drive.hasMedium() and not self.stopping:
+            time.sleep(MEDIUM_INTERVAL)
+
+    def jobUpdated(self, job, status):
+        """Log status of job"""
+        if job.drive is not None:
+            logging.info(''.join(['job ', job.jobID, ' (', job.drive.device, '): ', status]))
+        else:
+            logging.info(''.join(['job ', job.jobID, ': ', status]))
+        if self.api is not None:
+            self.api.jobUpdated(job, status)
+
+    def progressUpdated(self, job, event):
+        """Pass progress event to socket API subscribers (progress is logged
+        by the progress reporter)"""
+        if self.api is not None:
+            self.api.progressUpdated(job, event)
+
+
+def parseCommandLine():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Run Ipmlab without graphical user interface')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without graphical user interface (default for this command)')
+    parser.add_argument('--batch', dest='batchFolder',
+                        help='open (and resume) existing batch instead of creating a new one')
+    parser.add_argument('--watch', dest='watchFolder',
+                        help='import pick lists that are put in this folder')
+    parser.add_argument('--finalise', action='store_true',
+                        help='finalise batch and exit once all queued carriers are processed')
+    return parser.parse_args()
+
+
+def main():
+    """Main function"""
+    args = parseCommandLine()
+    config.version = __version__
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=LOG_FORMAT)
+
+    msg = settings.checkConfiguration(*settings.getConfiguration())
+    if msg is not None:
+        logging.error(msg)
+        sys.exit(1)
+
+    if args.watchFolder is not None and not os.path.isdir(args.watchFolder):
+        logging.error(''.join(['watch folder ', args.watchFolder, ' does not exist']))
+        sys.exit(1)
+    if args.watchFolder is None and not config.enableSocketAPI and not args.batchFolder:
+        logging.error('no source of carriers: enable the socket API, or use --watch or --batch')
+        sys.exit(1)
+    if args.finalise and args.watchFolder is None and not args.batchFolder:
+        logging.error('--finalise needs queued input: use --watch or --batch')
+        sys.exit(1)
+
+    myHeadless = headless(args.watchFolder)
+    try:
+        if args.batchFolder:
+            myHeadless.openBatch(args.batchFolder)
+        else:
+            myHeadless.createBatch()
+    except OSError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    # Quit after current media on SIGINT / SIGTERM (handled in main loop)
+    def requestStop(signum, frame):
+        myHeadless.stopRequested = True
+    signal.signal(signal.SIGINT, requestStop)
+    signal.signal(signal.SIGTERM, requestStop)
+
+    if config.enableSocketAPI:
+        myHeadless.startSocketAPI()
+    if args.finalise:
+        myHeadless.finaliseWhenIdle()
+
+    myHeadless.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,8 @@ Research department,  KB / National Library of the Netherlands
 
 import sys
 import os
-import csv
-import time
-import xml.etree.ElementTree as ETree
+import re
+import collections
 import threading
 import uuid
 import logging
@@ -22,12 +21,27 @@ from tkinter import filedialog as tkFileDialog
 from tkinter import scrolledtext as ScrolledText
 from tkinter import messagebox as tkMessageBox
 from tkinter import ttk
+from concurrent.futures import ThreadPoolExecutor
 from . import config
-from .kbapi import sru
-from .socketserver import server
-from . import pmworker
+from .socketserver import server, messageQueue
+from . import settings
+from .settings import getConfiguration, representsInt
+from . import manifest
+from . import drives
+from . import scheduler
+from . import progress
+from . import mdo
+from . import picklist
+from . import api
+from . import __version__
+
+# Pattern of a complete PPN (8 digits and a check digit); once entered the
+# PPN is looked up in advance
+PPN_PATTERN = re.compile(r'^\d{8}[\dXx]$')
+
+# Maximum number of lookups that are kept
+MAX_LOOKUPS = 8
 
-__version__ = '0.4.0'
 config.version = __version__
 
 class carrierEntry(tk.Frame):
@@ -50,44 +64,79 @@ class carrierEntry(tk.Frame):
         self.titleOld = ""
         self.volumeNoOld = ""
         self.carrierNumber = 0
-        self.t1 = None
+        self.drives = []
+        self.scheduler = None
+        self.runningCallbacks = False
+        # Catalogue lookups run in separate threads
+        self.lookupPool = ThreadPoolExecutor(max_workers=2)
+        self.lookups = {}
+        self.pendingLookup = None
         self.t2 = None
+        self.server = None
+        self.api = None
+        self.socketQueue = None
+        # Set when user pressed Quit
+        self.quitting = False
+        # Set when user pressed Finalise (socket API refuses new carriers)
+        self.finalising = False
+        # Jobs of which the load dialog was cancelled while quitting (these
+        # are re-queued when the batch is opened again)
+        self.interrupted = []
+        # Plain text messages from socket interface that wait for the
+        # PPN or Title widget
+        self.socketMessages = collections.deque()
         self.build_gui()
+        # Start polling callbacks from the scheduler
+        self.after(100, self.poll_callbacks)
 
     def on_quit(self, event=None):
-        """Wait until the medium that is currently being pocessed has
+        """Wait until the media that are currently being pocessed have
         finished, and quit (batch can be resumed by opening it in the File dialog)
         """
-        config.quitFlag = True
         self.bQuit.config(state='disabled')
+        self.quitting = True
         if config.batchIsOpen:
-            msg = 'User pressed Quit, quitting after current medium has been processed'
+            msg = 'User pressed Quit, quitting after current media have been processed'
             tkMessageBox.showinfo("Info", msg)
 
-        msg = 'User pressed Quit, click OK to close ipmlab'
-
         if not config.readyToStart:
             # User hasn't yet created or opened a batch
-            time.sleep(2)
+            msg = 'User pressed Quit, click OK to close ipmlab'
             tkMessageBox.showinfo("Quit", msg)
-            os._exit(0)
+            self.quit_application()
         else:
             # User has created or opened a batch
-            # Wait until processingMedium flag is reset to False
-            while config.processingMedium:
-                time.sleep(2)
-            # Wait 1 more second to avoid race condition
-            time.sleep(2)
+            # Quit once all workers have stopped
+            self.scheduler.shutdown(self.on_quit_finished)
 
-            handlers = self.logger.handlers[:]
+    def on_quit_finished(self):
+        """Quit after all workers have stopped"""
+        for jobID in self.interrupted:
+            manifest.index.setStatus(jobID, 'queued')
+        manifest.closeBatch()
+        handlers = self.logger.handlers[:]
 
-            for handler in handlers:
-                handler.close()
-                self.logger.removeHandler(handler)
+        for handler in handlers:
+            handler.close()
+            self.logger.removeHandler(handler)
 
-            msg = 'User pressed Quit, click OK to close ipmlab'
-            tkMessageBox.showinfo("Quit", msg)
-            os._exit(0)
+        msg = 'User pressed Quit, click OK to close ipmlab'
+        tkMessageBox.showinfo("Quit", msg)
+        self.quit_application()
+
+    def quit_application(self):
+        """Stop socket API and lookup threads, and leave main loop"""
+        if self.server is not None:
+            self.server.stop()
+            self.t2.join(timeout=config.secondsToTimeout)
+        if self.socketQueue is not None:
+            try:
+                self.root.tk.deletefilehandler(self.socketQueue.fileno())
+            except (AttributeError, tk.TclError):
+                pass
+            self.socketQueue.close()
+        self.lookupPool.shutdown(wait=False)
+        self.root.destroy()
 
 
     def on_create(self, event=None):
@@ -112,28 +161,9 @@ class carrierEntry(tk.Frame):
         with open(versionFile, "w") as vf:
             vf.write(config.version + '\n')
 
-        # Define batch manifest (CSV file with minimal metadata on each carrier)
-        config.batchManifest = os.path.join(config.batchFolder, 'manifest.csv')
-
-        # Write header row if batch manifest doesn't exist already
-        if not os.path.isfile(config.batchManifest):
-            headerBatchManifest = (['jobID',
-                                    'PPN',
-                                    'volumeNo',
-                                    'title',
-                                    'success',
-                                    'readErrors',
-                                    'badBlocks'])
-
-        # Open batch manifest in append mode
-        bm = open(config.batchManifest, "a", encoding="utf-8")
-
-        # Create CSV writer object
-        csvBm = csv.writer(bm, lineterminator='\n')
-
-        # Write header to batch manifest and close file
-        csvBm.writerow(headerBatchManifest)
-        bm.close()
+        # Create batch manifest (CSV file with minimal metadata on each carrier)
+        # and batch index
+        manifest.openBatch(config.batchFolder)
 
         # Set up logging
         successLogger = True
@@ -168,11 +198,14 @@ class carrierEntry(tk.Frame):
             self.volumeNo_entry.delete(0, tk.END)
             self.volumeNo_entry.insert(tk.END, "1")
             self.submit_button.config(state='normal')
+            self.import_button.config(state='normal')
 
             # Flag that is True if batch is open
             config.batchIsOpen = True
             # Set readyToStart flag to True,
             config.readyToStart = True
+            self.start_scheduler()
+            self.show_next_message()
 
 
     def on_open(self, event=None):
@@ -185,7 +218,6 @@ class carrierEntry(tk.Frame):
         options['parent'] = self.root
         options['title'] = 'Select batch directory'
         config.batchFolder = tkFileDialog.askdirectory(**self.dir_opt)
-        config.batchManifest = os.path.join(config.batchFolder, 'manifest.csv')
 
         # Check if batch was already finalized, and exit if so
         print(os.path.join(config.batchFolder, 'eob.txt'))
@@ -217,6 +249,7 @@ class carrierEntry(tk.Frame):
                     self.bNew.config(state='disabled')
                     self.bOpen.config(state='disabled')
                     self.submit_button.config(state='normal')
+                    self.import_button.config(state='normal')
                     self.bFinalise.config(state='normal')
                     if config.enablePPNLookup:
                         self.catid_entry.config(state='normal')
@@ -228,49 +261,58 @@ class carrierEntry(tk.Frame):
                     self.volumeNo_entry.delete(0, tk.END)
                     self.volumeNo_entry.insert(tk.END, "1")
 
+                    # Open batch manifest and batch index
+                    manifest.openBatch(config.batchFolder)
+
                     # Flag that is True if batch is open
                     config.batchIsOpen = True
                     # Set readyToStart flag to True
                     config.readyToStart = True
+                    self.start_scheduler()
+                    self.resume_batch()
+                    self.show_next_message()
 
     def on_finalise(self, event=None):
         """Finalise batch after user pressed finalise button"""
         msg = ("This will finalise the current batch.\n After finalising no further "
                "media can be added. Are you sure you want to do this?")
         if tkMessageBox.askyesno("Confirm", msg):
-            jobFile = 'eob.txt'
-            fJob = open(os.path.join(config.batchFolder, jobFile), "w", encoding="utf-8")
-            lineOut = 'EOB\n'
-            fJob.write(lineOut)
-            fJob.close()
-
             self.bFinalise.config(state='disabled')
-            self.submit_button.config(state='disabled')
-            if config.enablePPNLookup:
-                self.catid_entry.config(state='disabled')
-                self.usepreviousPPN_button.config(state='disabled')
-            else:
-                self.title_entry.config(state='disabled')
-                self.usepreviousTitle_button.config(state='disabled')
+            self.finalising = True
             self.volumeNo_entry.delete(0, tk.END)
-            self.volumeNo_entry.config(state='disabled')
-
-            # Wait until processingMedium flag is reset to False
-            while config.processingMedium:
-                time.sleep(2)
-            
-            config.readyToStart = False
-            config.finishedBatch = True
-
-            handlers = self.logger.handlers[:]
-            for handler in handlers:
-                handler.close()
-                self.logger.removeHandler(handler)
-            # Notify user
-            msg = 'Finished processing this batch'
-            tkMessageBox.showinfo("Finished", msg)
-            # Reset the GUI
-            self.reset_gui()
+            self.disable_carrier()
+
+            # Finalise once all queued media have been processed
+            self.scheduler.whenIdle(self.on_finalise_idle)
+
+    def on_finalise_idle(self):
+        """Stop workers after all queued media have been processed"""
+        self.scheduler.shutdown(self.on_finalise_finished)
+
+    def on_finalise_finished(self):
+        """Write end of batch file and reset the GUI after all workers have stopped"""
+        jobFile = 'eob.txt'
+        fJob = open(os.path.join(config.batchFolder, jobFile), "w", encoding="utf-8")
+        lineOut = 'EOB\n'
+        fJob.write(lineOut)
+        fJob.close()
+
+        config.readyToStart = False
+        config.batchIsOpen = False
+        config.finishedBatch = True
+        self.scheduler = None
+        self.finalising = False
+        manifest.closeBatch()
+
+        handlers = self.logger.handlers[:]
+        for handler in handlers:
+            handler.close()
+            self.logger.removeHandler(handler)
+        # Notify user
+        msg = 'Finished processing this batch'
+        tkMessageBox.showinfo("Finished", msg)
+        # Reset the GUI
+        self.reset_gui()
 
     def on_usepreviousPPN(self, event=None):
         """Add previously entered PPN to entry field"""
@@ -300,10 +342,12 @@ class carrierEntry(tk.Frame):
                 self.volumeNo_entry.insert(tk.END, volumeNoNew)
 
     def on_submit(self, event=None):
-        """Process one record and add it to the queue after user pressed submit button"""
+        """Process one record and add it to the queue after user pressed submit button.
+        The PPN is looked up in a separate thread, so the GUI stays responsive"""
 
-        config.processingMedium = True
-        mediumLoaded = False
+        if self.pendingLookup is not None:
+            # Previous lookup still running
+            return
 
         # Fetch entered values (strip any leading / tralue whitespace characters)
         if config.enablePPNLookup:
@@ -316,22 +360,6 @@ class carrierEntry(tk.Frame):
         volumeNo = self.volumeNo_entry.get().strip()
         self.volumeNoOld = volumeNo
 
-        if config.enablePPNLookup:
-            # Check for empty string
-            if str(catid) == '':
-                noGGCRecords = 0
-            else:
-                # Lookup catalog identifier
-                sruSearchString = 'OaiPmhIdentifier="GGC:AC:' + str(catid) + '"'
-                response = sru.search(sruSearchString, "GGC")
-
-                if not response:
-                    noGGCRecords = 0
-                else:
-                    noGGCRecords = response.sru.nr_of_records
-        else:
-            noGGCRecords = 1
-
         if not config.batchIsOpen:
             msg = "You must first create a batch or open an existing batch"
             tkMessageBox.showerror("Not ready", msg)
@@ -341,84 +369,333 @@ class carrierEntry(tk.Frame):
         elif int(volumeNo) < 1:
             msg = "Volume number must be greater than or equal to 1"
             tkMessageBox.showerror("Value error", msg)
-        elif noGGCRecords == 0:
+        elif config.enablePPNLookup and catid == '':
+            self.on_lookup_finished(catid, volumeNo, None)
+        elif config.enablePPNLookup:
+            # Lookup catalog identifier (re-use prefetched lookup if there is one)
+            future = self.lookups.get(catid)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.lookup(catid)
+            self.pendingLookup = future
+            self.disable_carrier()
+            self.cancel_button.config(state='normal')
+            self.lookup_label.config(text='Looking up PPN ' + catid + ' ...')
+            post = self.scheduler.post
+            future.add_done_callback(lambda f: post(self.on_lookup_done, catid, volumeNo, f))
+        else:
+            self.confirm_carrier(catid, title, volumeNo)
+
+    def on_cancel(self, event=None):
+        """Cancel pending PPN lookup after user pressed cancel button (the
+        result of the lookup is discarded)"""
+        if self.pendingLookup is not None:
+            logging.info('lookup of PPN cancelled by user')
+            self.pendingLookup = None
+            self.end_lookup()
+            self.enable_carrier()
+
+    def on_catid_typed(self, event=None):
+        """Prefetch catalogue record once entered PPN looks complete"""
+        catid = self.catid_entry.get().strip()
+        if config.batchIsOpen and PPN_PATTERN.match(catid) and catid not in self.lookups:
+            self.lookup(catid)
+
+    def lookup(self, catid):
+        """Start lookup of PPN in lookup thread, and return its future"""
+        future = self.lookupPool.submit(mdo.lookupTitle, catid)
+        self.lookups[catid] = future
+        # Only keep most recent lookups
+        while len(self.lookups) > MAX_LOOKUPS:
+            del self.lookups[next(iter(self.lookups))]
+        return future
+
+    def on_lookup_done(self, catid, volumeNo, future):
+        """Handle result of PPN lookup (ignored if lookup was cancelled)"""
+        if future is not self.pendingLookup:
+            return
+        self.pendingLookup = None
+        self.end_lookup()
+        try:
+            title = future.result()
+        except Exception as e:
+            # Lookup is retried on next submit
+            logging.error(''.join(['lookup of PPN ', catid, ' failed: ', str(e)]))
+            msg = "Catalogue lookup of PPN=" + catid + " failed:\n\n" + str(e)
+            tkMessageBox.showerror("Lookup failed", msg)
+            self.enable_carrier()
+            return
+        self.on_lookup_finished(catid, volumeNo, title)
+
+    def on_lookup_finished(self, catid, volumeNo, title):
+        """Ask for confirmation of looked up title"""
+        if title is None:
             # No matching record found
             msg = ("Search for PPN=" + str(catid) + " returned " +
                    "no matching record in catalog!")
             tkMessageBox.showerror("PPN not found", msg)
+            self.enable_carrier()
         else:
+            self.confirm_carrier(catid, title, volumeNo)
+
+    def end_lookup(self):
+        """Reset lookup widgets after a lookup has finished or was cancelled"""
+        self.cancel_button.config(state='disabled')
+        self.lookup_label.config(text='')
+
+    def confirm_carrier(self, catid, title, volumeNo):
+        """Display title and ask for confirmation, and add carrier to the queue"""
+        msg = "Found title:\n\n'" + title + "'.\n\n Is this correct?"
+        confirmed = tkMessageBox.askyesno("Confirm", msg)
+
+        # Check if carrier is already in batch
+        duplicates = manifest.index.findCarriers(catid, title, volumeNo)
+        if confirmed and duplicates:
+            if duplicates[-1]['status'] == 'finished':
+                state = "already imaged"
+            else:
+                state = "already queued"
+            msg = ("Volume " + volumeNo + " of '" + title + "' was " + state +
+                   " in this batch.\n\n Do you want to submit it again?")
+            confirmed = tkMessageBox.askyesno("Duplicate carrier", msg)
+
+        if confirmed:
+            self.add_carrier(catid, title, volumeNo)
+
+            # Ready for next carrier
+            self.reset_carrier()
+
+        else:
+            # Clear entry fields
+            self.enable_carrier()
             if config.enablePPNLookup:
-                # Matching record found. Display title and ask for confirmation
-                record = next(response.records)
-
-                # Title can be in either in:
-                # 1. title element
-                # 2. title element with maintitle attribute
-                # 3. title element with intermediatetitle attribute (3 in combination with 2)
-
-                titlesMain = record.titlesMain
-                titlesIntermediate = record.titlesIntermediate
-                titles = record.titles
-
-                if titlesMain != []:
-                    title = titlesMain[0]
-                    if titlesIntermediate != []:
-                        title = title + ", " + titlesIntermediate[0]
-                else:
-                    title = titles[0]
-
-            msg = "Found title:\n\n'" + title + "'.\n\n Is this correct?"
-            if tkMessageBox.askyesno("Confirm", msg):
-                msg = ("Please load medium ('" + title + "', volume " + str(volumeNo) +
-                       ") and press 'OK'")
-                tkMessageBox.showinfo("Load medium", msg)
-
-                while not mediumLoaded:
-                    try:
-                        fd= os.open(config.inDevice , os.O_RDONLY)
-                        os.close(fd)
-                        mediumLoaded = True
-                    except(PermissionError, OSError):
-                        msg = ("No medium found, please load medium and press 'OK'")
-                        tkMessageBox.showinfo("Load medium", msg)
-
-                # Create unique identifier for this job (UUID, based on host ID and current time)
-                jobID = str(uuid.uuid1())
-
-                # Update carrierNumber (only used to indicate order of all media in batch in widget)
-                self.carrierNumber += 1
-
-                # Set up dictionary that holds carrier data
-                carrierData = {}
-                carrierData['jobID'] = jobID
-                carrierData['PPN'] = catid
-                carrierData['title'] = title
-                carrierData['volumeNo'] = volumeNo
-
-                # Display PPN/Title + Volume number in treeview widget
-                self.tv.insert('', 0, text=str(self.carrierNumber), values=(catid, title, volumeNo))
-
-                if config.enablePPNLookup:
-                    self.catid_entry.config(state='disabled')
-                    self.usepreviousPPN_button.config(state='disabled')
-                else:
-                    self.title_entry.config(state='disabled')
-                    self.usepreviousTitle_button.config(state='disabled')
-
-                self.volumeNo_entry.config(state='disabled')
-                self.submit_button.config(state='disabled')
-                
-                # Process carrier in separate thread
-                self.t1 = threading.Thread(target=pmworker.processMedium, args=[carrierData])
-                self.t1.start()
-            
+                self.catid_entry.delete(0, tk.END)
+            else:
+                self.title_entry.delete(0, tk.END)
+            self.show_next_message()
+
+    def add_carrier(self, catid, title, volumeNo):
+        """Add carrier to the queue, it is processed as soon as a drive is available"""
+        # Create unique identifier for this job (UUID, based on host ID and current time)
+        jobID = str(uuid.uuid1())
+
+        # Update carrierNumber (only used to indicate order of all media in batch in widget)
+        self.carrierNumber += 1
+
+        # Set up dictionary that holds carrier data
+        carrierData = {}
+        carrierData['jobID'] = jobID
+        carrierData['PPN'] = catid
+        carrierData['title'] = title
+        carrierData['volumeNo'] = volumeNo
+
+        # Display PPN/Title + Volume number in treeview widget
+        self.tv.insert('', 0, iid=jobID, text=str(self.carrierNumber),
+                       values=(catid, title, volumeNo, '', ''))
+
+        return self.scheduler.submit(scheduler.job(carrierData))
+
+    def submitCarrier(self, catid, title, volumeNo):
+        """Add carrier that was submitted through the socket API to the queue"""
+        return self.add_carrier(catid, title, volumeNo)
+
+    def on_import(self, event=None):
+        """Import pick list after user pressed import button. Titles are
+        looked up in a separate thread"""
+        if not config.batchIsOpen:
+            msg = "You must first create a batch or open an existing batch"
+            tkMessageBox.showerror("Not ready", msg)
+            return
+
+        fileName = tkFileDialog.askopenfilename(parent=self.root,
+                                                title='Select pick list',
+                                                filetypes=[('CSV files', '*.csv'),
+                                                           ('Text files', '*.txt'),
+                                                           ('All files', '*')])
+        if not fileName:
+            return
+
+        try:
+            carriers = picklist.readPickList(fileName, config.enablePPNLookup)
+        except (OSError, ValueError) as e:
+            msg = "Cannot read pick list " + fileName + ": " + str(e)
+            tkMessageBox.showerror("Error", msg)
+            return
+
+        self.import_button.config(state='disabled')
+        logging.info(''.join(['importing pick list ', fileName, ' (',
+                              str(len(carriers)), ' carriers)']))
+        t = threading.Thread(target=self.resolve_pick_list, args=[carriers],
+                             name='picklist', daemon=True)
+        t.start()
+
+    def resolve_pick_list(self, carriers):
+        """Look up titles of carriers in pick list (runs in separate thread)"""
+        try:
+            resolved, unresolved = picklist.resolvePickList(carriers)
+        except Exception as e:
+            logging.error(''.join(['catalogue lookup of pick list failed: ', str(e)]))
+            self.scheduler.post(self.on_import_failed, str(e))
+        else:
+            self.scheduler.post(self.on_import_resolved, resolved, unresolved)
+
+    def on_import_failed(self, error):
+        """Report failed catalogue lookup of pick list"""
+        self.import_button.config(state='normal')
+        msg = "Catalogue lookup of pick list failed: " + error
+        tkMessageBox.showerror("Error", msg)
+
+    def on_import_resolved(self, resolved, unresolved):
+        """Ask for confirmation, and add carriers from pick list to the queue"""
+        self.import_button.config(state='normal')
+        if not config.batchIsOpen:
+            return
+
+        new = []
+        duplicates = []
+        for carrier in resolved:
+            if manifest.index.findCarriers(carrier['PPN'], carrier['title'], carrier['volumeNo']):
+                duplicates.append(carrier)
             else:
-                # Clear entry fields
-                if config.enablePPNLookup:
-                    self.catid_entry.delete(0, tk.END)
-                else:
-                    self.title_entry.delete(0, tk.END)
-                
+                new.append(carrier)
+
+        msg = "Found " + str(len(resolved)) + " carriers in pick list.\n"
+        if unresolved:
+            msg += ("\nNo catalogue record found for PPN(s): " + ", ".join(unresolved[:10]) +
+                    (" ..." if len(unresolved) > 10 else "") + "\n")
+            logging.warning(''.join(['no catalogue record found for PPN(s): ',
+                                     ', '.join(unresolved)]))
+        if duplicates:
+            msg += ("\n" + str(len(duplicates)) + " carrier(s) already imaged or queued " +
+                    "in this batch will be skipped.\n")
+        if not new:
+            tkMessageBox.showinfo("Import", msg + "\nNo carriers to add.")
+            return
+
+        msg += "\nAdd " + str(len(new)) + " carriers to the queue?"
+        if tkMessageBox.askyesno("Import", msg):
+            for carrier in new:
+                self.add_carrier(carrier['PPN'], carrier['title'], carrier['volumeNo'])
+            lastCarrier = new[-1]
+            self.catidOld = lastCarrier['PPN']
+            self.titleOld = lastCarrier['title']
+            self.volumeNoOld = lastCarrier['volumeNo']
+            logging.info(''.join(['added ', str(len(new)), ' carriers from pick list to queue']))
+
+    def start_scheduler(self):
+        """Start scheduler with one worker for each drive"""
+        self.scheduler = scheduler.scheduler(self.drives, self)
+        self.scheduler.start()
+
+    def resume_batch(self):
+        """Restore state of reopened batch from batch index, and add the jobs
+        that were not finished to the queue again"""
+        lastJob = manifest.index.lastJob()
+        if lastJob is not None:
+            self.catidOld = lastJob['PPN']
+            self.titleOld = lastJob['title']
+            self.volumeNoOld = lastJob['volumeNo']
+
+        unfinishedJobs = manifest.index.unfinishedJobs()
+        self.carrierNumber = manifest.index.noJobs() - len(unfinishedJobs)
+        logging.info(''.join(['batch contains ', str(self.carrierNumber),
+                              ' processed carriers, re-queueing ',
+                              str(len(unfinishedJobs)), ' unfinished carriers']))
+
+        for unfinishedJob in unfinishedJobs:
+            self.carrierNumber += 1
+            carrierData = {}
+            carrierData['jobID'] = unfinishedJob['jobID']
+            carrierData['PPN'] = unfinishedJob['PPN']
+            carrierData['title'] = unfinishedJob['title']
+            carrierData['volumeNo'] = unfinishedJob['volumeNo']
+            self.tv.insert('', 0, iid=carrierData['jobID'], text=str(self.carrierNumber),
+                           values=(carrierData['PPN'], carrierData['title'],
+                                   carrierData['volumeNo'], '', ''))
+            manifest.index.setStatus(carrierData['jobID'], 'queued')
+            self.scheduler.submit(scheduler.job(carrierData))
+
+    def loadMedium(self, job):
+        """Ask operator to load medium (called from worker thread)"""
+        return self.scheduler.callOnFrontend(self.ask_load_medium, job)
+
+    def removeMedium(self, job):
+        """Ask operator to remove medium (called from worker thread)"""
+        return self.scheduler.callOnFrontend(self.ask_remove_medium, job)
+
+    def ask_load_medium(self, job):
+        """Prompt operator to load medium into drive, return False if
+        operator cancelled"""
+        carrierData = job.carrierData
+        drive = job.drive
+        msg = ("Please load medium ('" + carrierData['title'] + "', volume " +
+               str(carrierData['volumeNo']) + ") into drive " + drive.device +
+               " and press 'OK'")
+        if not tkMessageBox.askokcancel("Load medium", msg):
+            return self.load_cancelled(job)
+
+        while not drive.hasMedium():
+            msg = ("No medium found, please load medium into drive " +
+                   drive.device + " and press 'OK'")
+            if not tkMessageBox.askokcancel("Load medium", msg):
+                return self.load_cancelled(job)
+        return True
+
+    def load_cancelled(self, job):
+        """Handle cancelled load dialog, and return False. If the user is
+        quitting, the job is not cancelled for good but resumed when the
+        batch is opened again"""
+        if self.quitting:
+            self.interrupted.append(job.jobID)
+        return False
+
+    def ask_remove_medium(self, job):
+        """Prompt operator to remove medium from drive"""
+        msg = ("Please remove the medium from drive " + job.drive.device +
+               ", then press 'OK'")
+        tkMessageBox.showinfo("Remove medium", msg)
+
+    def jobUpdated(self, job, status):
+        """Show drive and status of job in treeview widget"""
+        if self.api is not None:
+            self.api.jobUpdated(job, status)
+        if self.tv.exists(job.jobID):
+            if job.drive is not None:
+                self.tv.set(job.jobID, 'Drive', job.drive.device)
+            self.tv.set(job.jobID, 'Status', status)
+        if job.drive is None:
+            return
+        device = job.drive.device
+        if status in ['loading', 'imaging']:
+            self.driveJobs[device] = job.jobID
+            self.progressBars[device].config(value=0)
+            self.progressLabels[device].config(text=status)
+        elif self.driveJobs.get(device) == job.jobID:
+            # Imaging of job is done, and drive didn't start a new job yet
+            del self.driveJobs[device]
+            self.progressBars[device].config(value=0)
+            self.progressLabels[device].config(text='idle')
+
+    def progressUpdated(self, job, event):
+        """Show imaging progress of job in progress widgets of its drive"""
+        if self.api is not None:
+            self.api.progressUpdated(job, event)
+        if self.driveJobs.get(event['device']) != job.jobID:
+            return
+        if event['percent'] is not None:
+            self.progressBars[event['device']].config(value=event['percent'])
+        self.progressLabels[event['device']].config(text=progress.formatEvent(event))
+
+    def poll_callbacks(self):
+        """Check every 100ms if there are callbacks from the scheduler to run"""
+        # Callbacks may show dialogs that run a nested event loop, so make
+        # sure they are not run again from within that loop
+        if self.scheduler is not None and not self.runningCallbacks:
+            self.runningCallbacks = True
+            try:
+                self.scheduler.runCallbacks()
+            finally:
+                self.runningCallbacks = False
+        self.after(100, self.poll_callbacks)
 
     def setupLogger(self):
         """Set up logging-related settings"""
@@ -463,6 +740,7 @@ class carrierEntry(tk.Frame):
 
         # Read configuration file
         configFileDefinedFlag, configFileExistsFlag, configFileOpenFlag, configFileParsedFlag = getConfiguration()
+        self.drives = [drives.drive(inDevice) for inDevice in config.inDevices]
 
         self.root.title('ipmlab v.' + config.version)
         self.root.option_add('*tearOff', 'FALSE')
@@ -474,7 +752,7 @@ class carrierEntry(tk.Frame):
 
         # Set GUI geometry
         windowWidth = 700
-        windowHeight = 730
+        windowHeight = 730 + 30*len(self.drives)
 
         # get the screen dimension
         screenWidth = self.root.winfo_screenwidth()
@@ -542,6 +820,7 @@ class carrierEntry(tk.Frame):
             self.usepreviousPPN_button.grid(column=2, row=3, sticky='ew')
 
             self.catid_entry.grid(column=1, row=3, sticky='w')
+            self.catid_entry.bind('<KeyRelease>', self.on_catid_typed)
         else:
             # PPN lookup disabled, so present Title entry field
             tk.Label(self, text='Title').grid(column=0, row=3, sticky='w')
@@ -564,6 +843,10 @@ class carrierEntry(tk.Frame):
         
         self.volumeNo_entry.grid(column=1, row=4, sticky='w')
 
+        # Shows state of PPN lookup
+        self.lookup_label = tk.Label(self, text='', anchor='w')
+        self.lookup_label.grid(column=2, row=4, sticky='ew', columnspan=2)
+
         ttk.Separator(self, orient='horizontal').grid(column=0, row=5, columnspan=4, sticky='ew')
 
         self.submit_button = tk.Button(self,
@@ -575,21 +858,63 @@ class carrierEntry(tk.Frame):
                                        command=self.on_submit)
         self.submit_button.grid(column=1, row=6, sticky='ew')
 
+        # Pressing this button imports a pick list with multiple carriers
+        self.import_button = tk.Button(self,
+                                       text='Import list',
+                                       height=2,
+                                       width=4,
+                                       underline=0,
+                                       state='disabled',
+                                       command=self.on_import)
+        self.import_button.grid(column=2, row=6, sticky='ew')
+
+        # Pressing this button cancels a running PPN lookup
+        self.cancel_button = tk.Button(self,
+                                       text='Cancel',
+                                       height=2,
+                                       width=4,
+                                       underline=0,
+                                       state='disabled',
+                                       command=self.on_cancel)
+        self.cancel_button.grid(column=3, row=6, sticky='ew')
+
         ttk.Separator(self, orient='horizontal').grid(column=0, row=7, columnspan=4, sticky='ew')
 
         # Treeview widget displays info on entered carriers
         self.tv = ttk.Treeview(self, height=10,
-                               columns=('PPN', 'Title', 'VolumeNo'))
+                               columns=('PPN', 'Title', 'VolumeNo', 'Drive', 'Status'))
         self.tv.heading('#0', text='Queue #')
         self.tv.heading('#1', text='PPN')
         self.tv.heading('#2', text='Title')
         self.tv.heading('#3', text='Volume #')
+        self.tv.heading('#4', text='Drive')
+        self.tv.heading('#5', text='Status')
         self.tv.column('#0', stretch=tk.YES, width=5)
         self.tv.column('#1', stretch=tk.YES, width=10)
-        self.tv.column('#2', stretch=tk.YES, width=250)
+        self.tv.column('#2', stretch=tk.YES, width=200)
         self.tv.column('#3', stretch=tk.YES, width=5)
+        self.tv.column('#4', stretch=tk.YES, width=10)
+        self.tv.column('#5', stretch=tk.YES, width=10)
         self.tv.grid(column=0, row=8, sticky='ew', columnspan=4)
 
+        # Imaging progress of each drive
+        self.progressBars = {}
+        self.progressLabels = {}
+        self.driveJobs = {}
+        progressFrame = tk.Frame(self)
+        progressFrame.grid_columnconfigure(2, weight=1)
+        for i, drive in enumerate(self.drives):
+            tk.Label(progressFrame, text=drive.device).grid(column=0, row=i, sticky='w')
+            self.progressBars[drive.device] = ttk.Progressbar(progressFrame,
+                                                              orient='horizontal',
+                                                              length=200,
+                                                              mode='determinate',
+                                                              maximum=100)
+            self.progressBars[drive.device].grid(column=1, row=i, sticky='w', padx=5)
+            self.progressLabels[drive.device] = tk.Label(progressFrame, text='idle', anchor='w')
+            self.progressLabels[drive.device].grid(column=2, row=i, sticky='ew')
+        progressFrame.grid(column=0, row=9, sticky='ew', columnspan=4)
+
         # ScrolledText widget displays logging info
         self.st = ScrolledText.ScrolledText(self, state='disabled', height=15)
         self.st.configure(font='TkFixedFont')
@@ -601,54 +926,17 @@ class carrierEntry(tk.Frame):
         self.root.bind_all('<Control-Key-f>', self.on_finalise)
         self.root.bind_all('<Control-Key-q>', self.on_quit)
         self.root.bind_all('<Control-Key-s>', self.on_submit)
+        self.root.bind_all('<Control-Key-i>', self.on_import)
 
         # TODO keyboard shortcuts for Radiobox selections: couldn't find ANY info on how to do this!
 
         for child in self.winfo_children():
             child.grid_configure(padx=5, pady=5)
 
-        # Display message and exit if config file is either undefined, doesn't exist, cannot
-        # be opened or cannot be parsed
-        
-        if not configFileDefinedFlag:
-            msg = "configuration file is undefined"
-            errorExit(msg)
-        if not configFileExistsFlag:
-            msg = "configuration file doesn't exist"
-            errorExit(msg)
-        if not configFileOpenFlag:
-            msg = "configuration file cannot be opened"
-            errorExit(msg)
-        if not configFileParsedFlag:
-            msg = "unable to parse configuration file"
-            errorExit(msg)
-
-        # Check if all needed binaries exist, and exit if not
-        if not os.path.isfile(config.fiwalkBin):
-            msg = "Fiwalk binary " + config.fiwalkBin + " does not exist"
-            errorExit(msg)
-        if config.imagingApplication == "aaru":
-            if not os.path.isfile(config.aaruBin):
-                msg = "Aaru binary " + config.aaruBin + " does not exist"
-                errorExit(msg)
-        elif config.imagingApplication == "ddrescue":
-                if not os.path.isfile(config.ddrescueBin):
-                    msg = "Ddrescue binary " + config.ddrescueBin + " does not exist"
-                    errorExit(msg)
-        else:
-            msg = config.imagingApplication + " is not a recognized imagingApplication value"
-            errorExit(msg)
-
-        # Check if root dir exists, and exit if not
-        if not os.path.isdir(config.rootDir):
-            msg = "root directory " + config.rootDir + " does not exist"
-            errorExit(msg)
-
-        # Check if input device exists, and exit if not
-        try:
-            os.stat(config.inDevice)
-        except OSError:
-            msg = "inDevice " + config.inDevice + " does not exist"
+        # Display message and exit if configuration is invalid
+        msg = settings.checkConfiguration(configFileDefinedFlag, configFileExistsFlag,
+                                          configFileOpenFlag, configFileParsedFlag)
+        if msg is not None:
             errorExit(msg)
 
     def reset_carrier(self):
@@ -671,6 +959,37 @@ class carrierEntry(tk.Frame):
         self.volumeNo_entry.delete(0, tk.END)
         self.volumeNo_entry.insert(tk.END, "1")
 
+        # Show next value from socket interface (if any)
+        self.show_next_message()
+
+    def enable_carrier(self):
+        """Re-enable the carrier entry fields, keeping their values"""
+        if config.enablePPNLookup:
+            self.catid_entry.config(state='normal')
+            self.usepreviousPPN_button.config(state='normal')
+            self.catid_entry.focus_set()
+        else:
+            self.title_entry.config(state='normal')
+            self.usepreviousTitle_button.config(state='normal')
+            self.title_entry.focus_set()
+
+        self.volumeNo_entry.config(state='normal')
+        self.submit_button.config(state='normal')
+        self.import_button.config(state='normal')
+
+    def disable_carrier(self):
+        """Disable the carrier entry fields"""
+        if config.enablePPNLookup:
+            self.catid_entry.config(state='disabled')
+            self.usepreviousPPN_button.config(state='disabled')
+        else:
+            self.title_entry.config(state='disabled')
+            self.usepreviousTitle_button.config(state='disabled')
+
+        self.volumeNo_entry.config(state='disabled')
+        self.submit_button.config(state='disabled')
+        self.import_button.config(state='disabled')
+
     def reset_gui(self):
         """Reset the GUI"""
         # Reset carrierNumber
@@ -693,6 +1012,9 @@ class carrierEntry(tk.Frame):
         self.catidOld = ""
         self.titleOld = ""
         self.volumeNoOld = ""
+        self.lookups = {}
+        self.pendingLookup = None
+        self.end_lookup()
 
         # Update state of buttons / widgets
         self.bNew.config(state='normal')
@@ -700,6 +1022,7 @@ class carrierEntry(tk.Frame):
         self.bFinalise.config(state='disabled')
         self.bQuit.config(state='normal')
         self.submit_button.config(state='disabled')
+        self.import_button.config(state='disabled')
         if config.enablePPNLookup:
             self.catid_entry.config(state='disabled')
             self.usepreviousPPN_button.config(state='disabled')
@@ -708,39 +1031,82 @@ class carrierEntry(tk.Frame):
             self.usepreviousTitle_button.config(state='disabled')
         self.volumeNo_entry.config(state='disabled')
 
+    def watch_socket_requests(self, q):
+        """Handle requests from socket interface as soon as they are put in
+        queue q (a messageQueue)"""
+        self.socketQueue = q
+        try:
+            self.root.tk.createfilehandler(q.fileno(), tk.READABLE,
+                                           lambda fd, mask: self.handleSocketRequests(q))
+        except (AttributeError, tk.TclError):
+            # File handlers are not supported on this platform, so poll queue
+            self.after(50, self.poll_socket_requests)
+
+    def poll_socket_requests(self):
+        """Check every 50ms if there are requests from socket interface"""
+        if self.socketQueue is not None:
+            self.handleSocketRequests(self.socketQueue)
+            self.after(50, self.poll_socket_requests)
+
     def handleSocketRequests(self, q):
-        """ Update contents of PPN and Title widgets on incoming requests from socket interface
+        """Handle all pending requests from socket interface"""
+        q.clearNotifications()
+        while True:
+            try:
+                clientID, message = q.get_nowait()
+            except queue.Empty:
+                break
+            self.api.handle(clientID, message)
+
+    def legacyMessage(self, message):
+        """Queue plain text message (PPN or title) from socket interface"""
+        self.socketMessages.append(message)
+        self.show_next_message()
+
+    def show_next_message(self):
+        """ Update contents of PPN and Title widgets with next plain text
+        message from socket interface, if the widget is available (i.e. enabled
+        and empty). Messages that arrive while the operator is busy with the
+        previous carrier wait in socketMessages
         """
-        try:
-            message = q.get_nowait()
-            if config.enablePPNLookup:
-                try:
-                    catid = message
-                    self.catid_entry.delete(0, tk.END)
-                    self.catid_entry.insert(tk.END, catid)
-                    if catid == self.catidOld and catid != "":
-                        # Increase volume number value if existing catid
-                        volumeNoNew = str(int(self.volumeNoOld) + 1)
-                        self.volumeNo_entry.delete(0, tk.END)
-                        self.volumeNo_entry.insert(tk.END, volumeNoNew)
-                except:
-                    # TODO: catch more specific errors here?
-                    pass
-            else:
-                try:
-                    title = message
-                    self.title_entry.delete(0, tk.END)
-                    self.title_entry.insert(tk.END, title)
-                    if title == self.titleOld and title != "":
-                        # Increase volume number value if existing catid
-                        volumeNoNew = str(int(self.volumeNoOld) + 1)
-                        self.volumeNo_entry.delete(0, tk.END)
-                        self.volumeNo_entry.insert(tk.END, volumeNoNew)
-                except:
-                    # TODO: catch more specific errors here?
-                    pass
-        except queue.Empty:
-            pass
+        if not self.socketMessages or self.pendingLookup is not None:
+            return
+        if config.enablePPNLookup:
+            entry = self.catid_entry
+        else:
+            entry = self.title_entry
+        if str(entry.cget('state')) != 'normal' or entry.get().strip() != '':
+            return
+        message = self.socketMessages.popleft()
+
+        if config.enablePPNLookup:
+            try:
+                catid = message
+                self.catid_entry.delete(0, tk.END)
+                self.catid_entry.insert(tk.END, catid)
+                if catid == self.catidOld and catid != "":
+                    # Increase volume number value if existing catid
+                    volumeNoNew = str(int(self.volumeNoOld) + 1)
+                    self.volumeNo_entry.delete(0, tk.END)
+                    self.volumeNo_entry.insert(tk.END, volumeNoNew)
+                # Prefetch catalogue record
+                self.on_catid_typed()
+            except:
+                # TODO: catch more specific errors here?
+                pass
+        else:
+            try:
+                title = message
+                self.title_entry.delete(0, tk.END)
+                self.title_entry.insert(tk.END, title)
+                if title == self.titleOld and title != "":
+                    # Increase volume number value if existing catid
+                    volumeNoNew = str(int(self.volumeNoOld) + 1)
+                    self.volumeNo_entry.delete(0, tk.END)
+                    self.volumeNo_entry.insert(tk.END, volumeNoNew)
+            except:
+                # TODO: catch more specific errors here?
+                pass
 
 class QueueHandler(logging.Handler):
     """Class to send logging records to a queue
@@ -757,16 +1123,6 @@ class QueueHandler(logging.Handler):
         self.log_queue.put(record)
 
 
-def representsInt(s):
-    """Return True if s is an integer, False otherwise"""
-    # Source: http://stackoverflow.com/a/1267145
-    try:
-        int(s)
-        return True
-    except ValueError:
-        return False
-
-
 def errorExit(error):
     """Show error message in messagebox and then exit after userv presses OK"""
     tkMessageBox.showerror("Error", error)
@@ -783,107 +1139,6 @@ def findElementTextOld(elt, elementPath):
         return elementText
 
 
-def findElementText(elt, elementPath):
-    """Returns element text if it exists, errorExit if it doesn't exist"""
-    elementText = elt.findtext(elementPath)
-    if elementText is None:
-        elementText = ""
-    return elementText
-
-
-def getConfiguration():
-    """ Read configuration file, make all config variables available via
-    config.py and check that all file paths / executables exist.
-    This assumes an non-frozen script (no Py2Exe!)
-    """
-
-    configFileDefinedFlag = False
-    configFileExistsFlag = False
-    configFileOpenFlag = False
-    configFileParsedFlag = False
-
-    packageDir = os.path.dirname(os.path.abspath(__file__))
-    homeDir = os.path.normpath(os.path.expanduser("~"))
-    if packageDir.startswith(homeDir):
-        configFileUser = os.path.join(homeDir, '.config/ipmlab/config.xml')
-    else:
-        configFileUser = os.path.normpath('/etc/ipmlab/config.xml')
-    configFileDefinedFlag = True
-
-    # Check if user config file exists and exit if not
-    if os.path.isfile(configFileUser):
-        configFileExistsFlag = True
-
-    # Read contents to bytes object
-    if configFileExistsFlag:
-        try:
-            fConfig = open(configFileUser, "rb")
-            configBytes = fConfig.read()
-            fConfig.close()
-            configFileOpenFlag = True
-        except IOError:
-            pass
-
-    # Parse XML tree
-    if configFileOpenFlag:
-        try:
-            root = ETree.fromstring(configBytes)
-            configFileParsedFlag = True
-        except Exception:
-            pass
-
-    if configFileParsedFlag:
-
-        # Create empty element object & add config contents to it
-        # A bit silly but allows use of findElementText in etpatch
-
-        configElt = ETree.Element("bogus")
-        configElt.append(root)
-
-        config.inDevice = findElementText(configElt, './config/inDevice')
-        config.rootDir = findElementText(configElt, './config/rootDir')
-        config.prefixBatch = findElementText(configElt, './config/prefixBatch')
-        config.fiwalkBin = findElementText(configElt, './config/fiwalkBin')
-        config.imagingApplication = findElementText(configElt, './config/imagingApplication')
-        config.aaruBin = findElementText(configElt, './config/aaruBin')
-        config.ddrescueBin = findElementText(configElt, './config/ddrescueBin')
-        config.blockSize = findElementText(configElt, './config/blockSize')
-        config.retries = findElementText(configElt, './config/retries')
-    
-        # For below configuration variables, use default value if value cannot be
-        # read from config file (this ensures v1 will work with old config files)
-        try:
-            config.socketHost = findElementText(configElt, './config/socketHost')
-        except:
-            pass
-        try:
-            config.socketPort = findElementText(configElt, './config/socketPort')
-        except:
-            pass
-        try:
-            if findElementText(configElt, './config/enablePPNLookup') == "True":
-                config.enablePPNLookup = True
-            else:
-                config.enablePPNLookup = False
-        except:
-            pass
-        try:
-            if findElementText(configElt, './config/enableSocketAPI') == "True":
-                config.enableSocketAPI = True
-            else:
-                config.enableSocketAPI = False
-        except:
-            pass
-
-        # Normalise all file paths
-        config.rootDir = os.path.normpath(config.rootDir)
-        config.fiwalkBin = os.path.normpath(config.fiwalkBin)
-        config.aaruBin = os.path.normpath(config.aaruBin)
-        config.ddrescueBin = os.path.normpath(config.ddrescueBin)
-
-    return configFileDefinedFlag, configFileExistsFlag, configFileOpenFlag, configFileParsedFlag
-
-
 def main():
     """Main function"""
     config.version = __version__
@@ -893,29 +1148,18 @@ def main():
     root.protocol('WM_DELETE_WINDOW', myCarrierEntry.on_quit)
     # Start socket API as separate thread
     if config.enableSocketAPI:
-        q = queue.Queue()
-        myServer = server()
-        myCarrierEntry.t2 = threading.Thread(target=server.start,
-                                             args=[myServer,
-                                             config.socketHost,
-                                             config.socketPort,
-                                             q])
+        q = messageQueue()
+        myCarrierEntry.server = server()
+        myCarrierEntry.api = api.requestHandler(myCarrierEntry, myCarrierEntry.server)
+        myCarrierEntry.t2 = threading.Thread(target=myCarrierEntry.server.start,
+                                             args=[config.socketHost,
+                                                   config.socketPort,
+                                                   q],
+                                             name='socketAPI')
         myCarrierEntry.t2.start()
+        myCarrierEntry.watch_socket_requests(q)
 
-    while True:
-        if config.enableSocketAPI:
-            myCarrierEntry.handleSocketRequests(q)
-        root.update_idletasks()
-        root.update()
-        time.sleep(0.1)
-        if config.finishedMedium:
-            myCarrierEntry.t1.join()
-            # Prompt operator to remove medium
-            msg = ("Please remove the medium, then press 'OK'")
-            tkMessageBox.showinfo("Remove medium", msg)
-            myCarrierEntry.reset_carrier()
-            config.processingMedium = False
-            config.finishedMedium = False
+    root.mainloop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+"""
+Cache for SRU responses, with an in-memory LRU tier and an (optional)
+on-disk tier with a time to live and a size cap
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class responseCache():
+    """Thread-safe cache that maps keys (strings) to response bodies (bytes)"""
+
+    def __init__(self, cacheDir=None, ttl=86400, maxDiskSize=50*2**20,
+                 memoryItems=256):
+        """Initiate cache. If cacheDir is None only the in-memory tier is
+        used. ttl is in seconds, maxDiskSize in bytes"""
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.maxDiskSize = maxDiskSize
+        self.memoryItems = memoryItems
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.diskSize = 0
+        if self.cacheDir is not None:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            self.diskSize = sum(entry.stat().st_size for entry in self.diskEntries())
+
+    def get(self, key, stale=False):
+        """Return cached response for key, or None if there is none. Entries
+        that are older than ttl are only returned if stale is True (used
+        if the server cannot be reached)"""
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                storedAt, content = self.memory[key]
+                if stale or now - storedAt < self.ttl:
+                    self.memory.move_to_end(key)
+                    return content
+
+        if self.cacheDir is None:
+            return None
+
+        fileName = self.fileName(key)
+        try:
+            storedAt = os.path.getmtime(fileName)
+            if not stale and now - storedAt >= self.ttl:
+                return None
+            with open(fileName, "rb") as fCache:
+                content = fCache.read()
+        except OSError:
+            return None
+
+        self.putMemory(key, content, storedAt)
+        return content
+
+    def put(self, key, content):
+        """Add response to cache"""
+        now = time.time()
+        self.putMemory(key, content, now)
+
+        if self.cacheDir is None:
+            return
+
+        fileName = self.fileName(key)
+        tempFile = fileName + '.' + str(threading.get_ident()) + '.tmp'
+        with self.lock:
+            try:
+                oldSize = os.path.getsize(fileName)
+            except OSError:
+                oldSize = 0
+            try:
+                with open(tempFile, "wb") as fCache:
+                    fCache.write(content)
+                os.replace(tempFile, fileName)
+            except OSError:
+                # Cache is best effort, so just skip disk tier
+                return
+            self.diskSize += len(content) - oldSize
+            if self.diskSize > self.maxDiskSize:
+                self.evict()
+
+    def putMemory(self, key, content, storedAt):
+        """Add response to in-memory tier, and drop least recently used
+        entries if it is full"""
+        with self.lock:
+            self.memory[key] = (storedAt, content)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memoryItems:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        """Remove oldest entries from disk tier until its size is below
+        maxDiskSize (caller must hold lock)"""
+        entries = sorted(self.diskEntries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.diskSize <= self.maxDiskSize:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.diskSize -= size
+            except OSError:
+                pass
+
+    def diskEntries(self):
+        """Return list of all entries in disk tier"""
+        return [entry for entry in os.scandir(self.cacheDir)
+                if entry.is_file() and entry.name.endswith('.xml')]
+
+    def fileName(self, key):
+        """Return name of file in disk tier for key"""
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, digest + '.xml')
@@ -3,10 +3,16 @@
 Python API for KB SRU
 """
 
+import re
 import sys
 import urllib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from lxml import etree
+from .cache import responseCache
 
 SRU_BASEURL = 'http://jsru.kb.nl/sru/sru'
 SRU_BASEURL += '?version=1.2&maximumRecords=%i'
@@ -63,38 +69,105 @@ NSMAPGGC = {"srw": srw_ns,
             "dcterms": dcterms_ns,
             "dcx": dcx_ns}
 
+# Number of records per page that is requested when iterating beyond the
+# first page of a search
+PAGESIZE = 50
+
+# Query for the catalogue record of a PPN in the GGC collection
+PPN_QUERY = 'OaiPmhIdentifier="GGC:AC:%s"'
+
+# PPN in record identifier URI (e.g. http://opc4.kb.nl/DB=1/PPN?PPN=144082667)
+PPN_URI = re.compile(r'PPN=(\w+)')
+
+# Connect and read timeouts (in seconds) of SRU requests
+TIMEOUT = (5, 20)
+
+# Number of retries (with exponential backoff) after connection errors and
+# 5xx responses
+RETRIES = 3
+
+# Server errors that are retried
+RETRY_STATUS = (500, 502, 503, 504)
+
+# HTTP session with connection pool, shared by all sru instances (so
+# connections are kept alive between requests). Created by getSession
+session = None
+sessionLock = threading.Lock()
+
+
+def getSession():
+    """Return shared HTTP session (create it if it doesn't exist)"""
+    global session
+    with sessionLock:
+        if session is None:
+            retry = Retry(total=RETRIES, connect=RETRIES, read=RETRIES,
+                          status=RETRIES, backoff_factor=0.5,
+                          status_forcelist=RETRY_STATUS, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=10,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+
+def configureSession(connectTimeout=5, readTimeout=20, retries=3):
+    """Set timeouts (in seconds) and number of retries of SRU requests"""
+    global TIMEOUT, RETRIES, session
+    with sessionLock:
+        TIMEOUT = (connectTimeout, readTimeout)
+        RETRIES = retries
+        # Session is re-created with new settings on next request
+        session = None
+
+
+# Cache of SRU responses, shared by all sru instances (in-memory only,
+# unless replaced with setCache)
+cache = responseCache()
+
+
+def setCache(newCache):
+    """Replace the SRU response cache (e.g. by one with a disk tier)"""
+    global cache
+    cache = newCache
+
 
 class response():
     def __init__(self, record_data, sru):
         self.record_data = record_data
         self.sru = sru
+        self.fields = None
+
+    def indexFields(self):
+        # Index text content of all elements by (tag, '', '') and by
+        # (tag, attribute name, attribute value) for each of their attributes,
+        # so the tree is only walked once for all properties
+        fields = {}
+        for r in self.record_data.iter():
+            tag = r.tag
+            if not isinstance(tag, str):
+                # Comments and processing instructions
+                continue
+            fields.setdefault((tag, '', ''), []).append(r.text)
+            for attributeName, attributeValue in r.attrib.items():
+                fields.setdefault((tag, attributeName, attributeValue), []).append(r.text)
+        self.fields = fields
 
     def getElementText(self, tagName, attributeName, attributeValue):
         # Returns text content of all elements for which tag matches tagName,
         # and attribute value equals attributeValue. Set attributeName to empty
         # string to get all tagName matches.
-        textFields = []
-        for r in self.record_data.iter():
-            if r.tag == tagName:
-                if attributeName != '':
-                    try:
-                        if r.attrib[attributeName] == attributeValue:
-                            textFields.append(r.text)
-                    except KeyError:
-                        pass
-                else:
-                    textFields.append(r.text)
-        return textFields
+        if self.fields is None:
+            self.indexFields()
+        if attributeName == '':
+            attributeValue = ''
+        return list(self.fields.get((tagName, attributeName, attributeValue), []))
 
     @property
     def records(self):
-        if self.sru.nr_of_records == 0:
-            record_data = "<xml></xml>"
-        else:
-            ns = {'zs': 'http://www.loc.gov/zing/srw/'}
-            record_data = self.record_data.xpath("zs:records/zs:record",
-                                                 namespaces=ns)[0]
-        return record(record_data, self.sru)
+        # Iterator over all records of the search, starting with the ones
+        # in this (first) page of results
+        return record(self.record_data, self.sru)
 
     # Below property functions all return a list with all instances that satisfy
     # criteria
@@ -252,35 +325,45 @@ class response():
                                    ''))
 
 
+def page_records(record_data):
+    # Returns list of all record elements in page of search results
+    return record_data.xpath("zs:records/zs:record",
+                             namespaces={'zs': srw_ns})
+
+
 class record():
+    # Iterates over the records of a search. Records that are already in
+    # the current page are returned without querying the server; the next
+    # page (of PAGESIZE records) is only fetched once the current one is
+    # used up.
     def __init__(self, record_data, sru):
-        self.record_data = record_data
         self.sru = sru
+        self.page = page_records(record_data)
+        self.position = 0
+        self.next_record = sru.startrecord + len(self.page)
 
     def __iter__(self):
         return self
 
     # This works under Python 2.7
     def next(self):
-        if self.sru.nr_of_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.nr_of_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return response(record_data, self.sru)
-        else:
-            raise StopIteration
+        return self.__next__()
 
     # This works under Python 3
     def __next__(self):
-        if self.sru.nr_of_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.nr_of_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return response(record_data, self.sru)
-        else:
-            raise StopIteration
+        if self.position >= len(self.page):
+            if not self.page or self.next_record > self.sru.nr_of_records:
+                raise StopIteration
+            self.sru.startrecord = self.next_record
+            self.sru.maximumrecords = max(self.sru.maximumrecords, PAGESIZE)
+            self.page = page_records(self.sru.run_query())
+            self.position = 0
+            self.next_record += len(self.page)
+            if not self.page:
+                raise StopIteration
+        record_data = self.page[self.position]
+        self.position += 1
+        return response(record_data, self.sru)
 
 
 class sru():
@@ -335,11 +418,79 @@ class sru():
         if self.DEBUG:
             sys.stdout.write(url)
 
-        r = requests.get(url)
-
-        if not r.status_code == 200:
-            raise Exception('Error while getting data from %s' % url)
+        # The URL contains query, collection, schema and paging parameters,
+        # so it is used as cache key
+        content = cache.get(url)
+        if content is not None:
+            return etree.fromstring(content)
+
+        try:
+            r = getSession().get(url, timeout=TIMEOUT)
+            if not r.status_code == 200:
+                raise Exception('Error while getting data from %s' % url)
+        except Exception:
+            # Fall back to expired cache entry if server cannot be reached
+            content = cache.get(url, stale=True)
+            if content is None:
+                raise
+            return etree.fromstring(content)
 
         record_data = etree.fromstring(r.content)
 
+        # Don't cache empty results, as records may be added to the catalogue
+        nr_of_records = record_data.findtext('{%s}numberOfRecords' % srw_ns)
+        if nr_of_records is not None and nr_of_records.strip() not in ('', '0'):
+            cache.put(url, r.content)
+
         return record_data
+
+
+def record_ppn(rec):
+    # Returns PPN of record (response object), or None if record doesn't
+    # contain an identifier URI with a PPN
+    for uri in rec.recordIdentifiersURI + rec.identifiersURI:
+        if uri:
+            match = PPN_URI.search(uri)
+            if match:
+                return match.group(1)
+    return None
+
+
+def search_ppns(ppns, collection="GGC", batch_size=20, workers=4):
+    # Bulk lookup of PPNs. Returns dictionary that maps each PPN to its
+    # record (response object), or None if no record was found.
+    # PPNs are looked up in batches of OR-queries that run in parallel;
+    # PPNs that cannot be matched to a record in the results of their batch
+    # are looked up separately (also in parallel).
+    ppns = list(dict.fromkeys(ppns))
+    batches = [ppns[i:i + batch_size] for i in range(0, len(ppns), batch_size)]
+
+    def search_batch(batch):
+        found = {}
+        query = ' OR '.join(PPN_QUERY % ppn for ppn in batch)
+        try:
+            resp = sru().search(query, collection, maximumrecords=len(batch))
+        except Exception:
+            # Remaining lookups are retried separately
+            return found
+        if resp:
+            for rec in resp.records:
+                ppn = record_ppn(rec)
+                if ppn in batch and ppn not in found:
+                    found[ppn] = rec
+        return found
+
+    def search_single(ppn):
+        resp = sru().search(PPN_QUERY % ppn, collection)
+        if not resp:
+            return None
+        return next(resp.records)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for found in pool.map(search_batch, batches):
+            results.update(found)
+        missing = [ppn for ppn in ppns if ppn not in results]
+        for ppn, rec in zip(missing, pool.map(search_single, missing)):
+            results[ppn] = rec
+    return results
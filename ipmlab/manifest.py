@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+"""Batch manifest (CSV file with minimal metadata on each carrier), and
+the batch index that is kept alongside it (see batchindex)"""
+
+import os
+import csv
+import logging
+import threading
+from . import config
+from . import batchindex
+
+# Column headers of batch manifest
+HEADER = ['jobID',
+          'PPN',
+          'volumeNo',
+          'title',
+          'success',
+          'readErrors',
+          'badBlocks']
+
+# Columns with ddrescue map statistics (see ddrescue.analyseMap), which are
+# empty for images made with Aaru
+MAP_STATISTICS = ['rescued',
+                  'nonTried',
+                  'nonTrimmed',
+                  'nonScraped',
+                  'badSector',
+                  'noBadExtents',
+                  'largestBadExtent',
+                  'fragmentation']
+
+# Columns with the sectors that Aaru could not read (number of sectors, and
+# ranges of sector numbers), which are empty for images made with ddrescue
+AARU_ERRORS = ['badSectors',
+               'badSectorRanges']
+
+HEADER += MAP_STATISTICS + AARU_ERRORS
+
+# Lock that prevents workers from writing to the manifest at the same time
+manifestLock = threading.Lock()
+
+# Batch index of current batch
+index = None
+
+
+def openBatch(batchFolder):
+    """Open batch manifest and batch index of batchFolder (both are created
+    if they don't exist)"""
+    global index
+    config.batchManifest = os.path.join(batchFolder, 'manifest.csv')
+    newIndex = not os.path.isfile(os.path.join(batchFolder, batchindex.INDEXFILE))
+    index = batchindex.batchIndex(batchFolder)
+    if not os.path.isfile(config.batchManifest):
+        # Write header row
+        addRow(HEADER)
+        return
+    upgradeManifest(config.batchManifest)
+    if newIndex:
+        # Existing batch without index
+        logging.info("building batch index from batch manifest")
+    # Jobs that are in the manifest are finished, even if the index wasn't
+    # updated after their row was written
+    index.importManifest(config.batchManifest)
+
+
+def upgradeManifest(batchManifest):
+    """Rewrite batch manifest that was created by an older version with fewer
+    columns, so that all rows match HEADER (missing values are left empty)"""
+    with open(batchManifest, "r", encoding="utf-8") as bm:
+        rows = list(csv.reader(bm))
+    if not rows or rows[0] == HEADER:
+        return
+    if rows[0] != HEADER[:len(rows[0])]:
+        logging.warning(''.join(["unexpected header in batch manifest ", batchManifest,
+                                 ", manifest not upgraded"]))
+        return
+    logging.info(''.join(["adding columns ", ','.join(HEADER[len(rows[0]):]),
+                          " to batch manifest"]))
+    padding = [''] * (len(HEADER) - len(rows[0]))
+    tmpManifest = batchManifest + '.tmp'
+    with open(tmpManifest, "w", encoding="utf-8") as bm:
+        csvBm = csv.writer(bm, lineterminator='\n')
+        csvBm.writerow(HEADER)
+        for row in rows[1:]:
+            csvBm.writerow(row + padding[:max(len(HEADER) - len(row), 0)])
+    os.replace(tmpManifest, batchManifest)
+
+
+def closeBatch():
+    """Close batch index"""
+    global index
+    if index is not None:
+        index.close()
+        index = None
+
+
+def addRow(row):
+    """Add row to batch manifest (and to batch index)"""
+    with manifestLock:
+        # Open batch manifest in append mode
+        with open(config.batchManifest, "a", encoding="utf-8") as bm:
+            # Create CSV writer object
+            csvBm = csv.writer(bm, lineterminator='\n')
+            # Write row to batch manifest
+            csvBm.writerow(row)
+    if index is not None and row is not HEADER:
+        index.setManifestRow(row)
@@ -5,7 +5,40 @@ import os
 import io
 import logging
 import xml.etree.ElementTree as ETree
-from .kbapi import sru
+from .kbapi.sru import sru
+
+
+def getTitle(record):
+    """Return title of catalogue record"""
+
+    # Title can be in either in:
+    # 1. title element
+    # 2. title element with maintitle attribute
+    # 3. title element with intermediatetitle attribute (3 in combination with 2)
+
+    titlesMain = record.titlesMain
+    titlesIntermediate = record.titlesIntermediate
+    titles = record.titles
+
+    if titlesMain != []:
+        title = titlesMain[0]
+        if titlesIntermediate != []:
+            title = title + ", " + titlesIntermediate[0]
+    else:
+        title = titles[0]
+
+    return title
+
+
+def lookupTitle(PPN):
+    """Look up PPN in catalogue, and return its title (or None if no
+    matching record was found)"""
+    sruSearchString = 'OaiPmhIdentifier="GGC:AC:' + str(PPN) + '"'
+    # Use separate sru instance, as lookups may run in multiple threads
+    response = sru().search(sruSearchString, "GGC")
+    if not response:
+        return None
+    return getTitle(next(response.records))
 
 def writeMDORecord(PPN, writeDirectory):
     """Write MDO record for a PPN to file"""
@@ -13,13 +46,17 @@ def writeMDORecord(PPN, writeDirectory):
     fileOut = os.path.join(writeDirectory, "meta-kbmdo.xml")
 
     sruSearchString = 'OaiPmhIdentifier="GGC:AC:' + str(PPN) + '"'
-    response = sru.search(sruSearchString, "GGC")
+    # Use separate sru instance, as records may be fetched from multiple threads.
+    # SRU responses are cached, so this re-uses the record that was fetched
+    # when the carrier was submitted
+    response = sru().search(sruSearchString, "GGC")
 
     if not response:
         logging.error("No matching metadata record found in KB-MDO")
         success = False
     else:
-        recordData = next(response.records).record_data
+        # Write complete SRU response (first page of results)
+        recordData = response.record_data
         recordAsString = ETree.tostring(recordData, encoding='UTF-8', method='xml')
 
         try:
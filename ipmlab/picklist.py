@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+"""Pick lists: CSV files that list the carriers of a shipment (one carrier
+per line), with columns PPN, volumeNo and (optionally) title. The volumeNo
+column may be left empty (or omitted), in which case subsequent carriers with
+the same PPN (or title) are numbered 1, 2, 3, etc. A plain list of PPNs (one
+per line) is also a valid pick list. Titles of carriers that are not in the
+pick list are looked up in the catalogue
+"""
+
+import sys
+import csv
+import argparse
+from .kbapi.sru import search_ppns
+from . import mdo
+
+# Column headers of pick list
+HEADER = ['PPN', 'volumeNo', 'title']
+
+
+def readPickList(fileName, enablePPNLookup=True):
+    """Read pick list, and return list of carriers (dictionaries with PPN,
+    volumeNo and title items). Raises ValueError if the pick list is invalid"""
+
+    with open(fileName, "r", encoding="utf-8", newline='') as fPick:
+        rows = [row for row in csv.reader(fPick) if row and any(cell.strip() for cell in row)]
+
+    # Skip header row
+    if rows and rows[0][0].strip().lower() == 'ppn':
+        rows = rows[1:]
+
+    carriers = []
+    volumeCounts = {}
+    for lineNo, row in enumerate(rows, start=1):
+        row = [cell.strip() for cell in row] + ['', '']
+        PPN, volumeNo, title = row[0], row[1], row[2]
+
+        if not enablePPNLookup:
+            # Carriers are identified by title only
+            PPN = ''
+            if title == '':
+                raise ValueError('no title for carrier ' + str(lineNo))
+        elif PPN == '':
+            raise ValueError('no PPN for carrier ' + str(lineNo))
+
+        key = PPN if PPN != '' else title
+        if volumeNo == '':
+            volumeCounts[key] = volumeCounts.get(key, 0) + 1
+            volumeNo = str(volumeCounts[key])
+        else:
+            try:
+                if int(volumeNo) < 1:
+                    raise ValueError
+            except ValueError:
+                raise ValueError('invalid volume number for carrier ' + str(lineNo))
+            volumeCounts[key] = int(volumeNo)
+
+        carriers.append({'PPN': PPN, 'volumeNo': volumeNo, 'title': title})
+
+    return carriers
+
+
+def resolvePickList(carriers):
+    """Look up titles of all carriers that don't have one. Returns list of
+    resolved carriers, and list of PPNs for which no catalogue record was found"""
+
+    PPNs = [carrier['PPN'] for carrier in carriers if carrier['title'] == '']
+    records = search_ppns(PPNs) if PPNs else {}
+
+    resolved = []
+    unresolved = []
+    for carrier in carriers:
+        if carrier['title'] == '':
+            record = records.get(carrier['PPN'])
+            if record is None:
+                if carrier['PPN'] not in unresolved:
+                    unresolved.append(carrier['PPN'])
+                continue
+            carrier = dict(carrier, title=mdo.getTitle(record))
+        resolved.append(carrier)
+
+    return resolved, unresolved
+
+
+def writePickList(fileName, carriers):
+    """Write carriers to pick list"""
+    with open(fileName, "w", encoding="utf-8", newline='') as fPick:
+        csvPick = csv.writer(fPick, lineterminator='\n')
+        csvPick.writerow(HEADER)
+        for carrier in carriers:
+            csvPick.writerow([carrier['PPN'], carrier['volumeNo'], carrier['title']])
+
+
+def main():
+    """Resolve titles of pick list in advance, and write result to new pick
+    list (which can then be imported without any catalogue lookups)"""
+    parser = argparse.ArgumentParser(description='Look up the titles of all carriers '
+                                                 'in an Ipmlab pick list')
+    parser.add_argument('pickListIn', help='input pick list (CSV)')
+    parser.add_argument('pickListOut', help='output pick list (CSV) with titles')
+    args = parser.parse_args()
+
+    try:
+        carriers = readPickList(args.pickListIn)
+        resolved, unresolved = resolvePickList(carriers)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('error: ' + str(e) + '\n')
+        sys.exit(1)
+    except Exception as e:
+        sys.stderr.write('error: catalogue lookup failed (' + str(e) + ')\n')
+        sys.exit(1)
+
+    writePickList(args.pickListOut, resolved)
+    sys.stdout.write('resolved ' + str(len(resolved)) + ' carriers\n')
+    for PPN in unresolved:
+        sys.stderr.write('no catalogue record found for PPN ' + PPN + '\n')
+    if unresolved:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,91 +3,41 @@
 """
 
 import os
-import glob
-import csv
-import hashlib
 import logging
+import xml.etree.ElementTree as ETree
+from concurrent.futures import ThreadPoolExecutor
 from . import config
 from . import aaru
 from . import ddrescue
 from . import mdo
 from . import fiwalk
+from . import sidecar
+from . import checksums
+from . import manifest
+from . import progress
 
 
-def generate_file_md5(fileIn):
-    """Generate MD5 hash of file"""
-
-    # fileIn is read in chunks to ensure it will work with (very) large files as well
-    # Adapted from: http://stackoverflow.com/a/1131255/1209004
-
-    blocksize = 2**20
-    m = hashlib.md5()
-    with open(fileIn, "rb") as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
-
-
-def generate_file_sha512(fileIn):
-    """Generate sha512 hash of file"""
-
-    # fileIn is read in chunks to ensure it will work with (very) large files as well
-    # Adapted from: http://stackoverflow.com/a/1131255/1209004
-
-    blocksize = 2**20
-    m = hashlib.sha512()
-    with open(fileIn, "rb") as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
-
-
-def checksumDirectory(directory):
-    """Calculate checksums for all files in directory"""
-
-    # All files in directory
-    allFiles = glob.glob(directory + "/*")
-
-    # Dictionary for storing results
-    checksums = {}
-
-    for fName in allFiles:
-        hashString = generate_file_sha512(fName)
-        checksums[fName] = hashString
-
-    # Write checksum file
-    try:
-        fChecksum = open(os.path.join(directory, "checksums.sha512"), "w", encoding="utf-8")
-        for fName in checksums:
-            lineOut = checksums[fName] + " " + os.path.basename(fName) + '\n'
-            fChecksum.write(lineOut)
-        fChecksum.close()
-        wroteChecksums = True
-    except IOError:
-        wroteChecksums = False
-
-    return wroteChecksums
-
-
-def processMedium(carrierData):
-    """Process one medium/carrier"""
+def imageMedium(carrierData, drive, onProgress=None):
+    """Extract data from the medium in drive to disk image. This is the only
+    stage that needs the drive. Progress events are passed to onProgress.
+    Returns dictionary with imaging results"""
 
     jobID = carrierData['jobID']
-    PPN = carrierData['PPN']
 
     logging.info(''.join(['### Job identifier: ', jobID]))
     logging.info(''.join(['PPN: ', carrierData['PPN']]))
     logging.info(''.join(['Title: ', carrierData['title']]))
     logging.info(''.join(['Volume number: ', carrierData['volumeNo']]))
+    logging.info(''.join(['Input device: ', drive.device]))
 
     # Initialise success status
     success = True
+    badBlocks = False
+    mapStatistics = None
+    badSectorRanges = None
+
+    # Checksums that are computed during imaging
+    knownChecksums = {}
 
     # Create output folder for this medium
     dirMedium = os.path.join(config.batchFolder, jobID)
@@ -97,12 +47,15 @@ def processMedium(carrierData):
 
     logging.info('*** Extracting data using ' + config.imagingApplication + ' ***')
 
+    reporter = progress.progressReporter(jobID, drive.device, onProgress,
+                                         config.progressLogInterval)
     if config.imagingApplication == "aaru":
 
-        resultAaru = aaru.extractData(dirMedium, jobID)
+        resultAaru = aaru.extractData(dirMedium, jobID, drive.device, reporter)
         imageFile = resultAaru["imageFile"]
         statusAaru = resultAaru["status"]
         readErrors = resultAaru["readErrors"]
+        badSectorRanges = resultAaru["badSectorRanges"]
 
         logging.info(''.join(['aaru command: ', resultAaru['cmdStr']]))
         logging.info(''.join(['aaru-status: ', str(resultAaru['status'])]))
@@ -116,11 +69,17 @@ def processMedium(carrierData):
             logging.error("Aaru dumping resulted in read error(s)")
 
     elif config.imagingApplication == "ddrescue":
-        resultDdrescue = ddrescue.extractData(dirMedium, jobID)
+        if config.inlineHashing:
+            hashAlgorithms = config.checksumAlgorithms
+        else:
+            hashAlgorithms = None
+        resultDdrescue = ddrescue.extractData(dirMedium, jobID, drive.device,
+                                              hashAlgorithms, reporter)
         imageFile = resultDdrescue["imageFile"]
         statusDdrescue = resultDdrescue["status"]
         readErrors = resultDdrescue["readErrors"]
         badBlocks = resultDdrescue["badBlocks"]
+        mapStatistics = resultDdrescue["mapStatistics"]
 
         logging.info(''.join(['ddrescue command: ', resultDdrescue['cmdStr']]))
         logging.info(''.join(['ddrescue status: ', str(resultDdrescue['status'])]))
@@ -133,7 +92,26 @@ def processMedium(carrierData):
             success = False
             logging.error("Ddrescue dumping resulted in one or more bad blocks")
 
-    # Generate dfxml metadata and store as file
+        if resultDdrescue["imageDigests"]:
+            knownChecksums[os.path.basename(imageFile)] = resultDdrescue["imageDigests"]
+
+    logging.info(''.join(['*** Finished imaging medium in ', drive.device, ' ***']))
+
+    # All results to dictionary
+    dictOut = {}
+    dictOut["dirMedium"] = dirMedium
+    dictOut["success"] = success
+    dictOut["readErrors"] = readErrors
+    dictOut["badBlocks"] = badBlocks
+    dictOut["mapStatistics"] = mapStatistics
+    dictOut["badSectorRanges"] = badSectorRanges
+    dictOut["knownChecksums"] = knownChecksums
+
+    return dictOut
+
+
+def generateDfxml(dirMedium, jobID):
+    """Generate dfxml metadata and store as file, return True on success"""
     logging.info('*** Generating dfxml metadata ***')
     resultFiwalk = fiwalk.runFiwalk(dirMedium, jobID)
     statusFiwalk = resultFiwalk["status"]
@@ -142,21 +120,72 @@ def processMedium(carrierData):
     logging.info(''.join(['fiwalk status: ', str(resultFiwalk['status'])]))
 
     if statusFiwalk != 0:
-        success = False
         logging.error("Fiwalk exited with abnormal exit status")
+        return False
+    return True
+
+
+def generateFileMetadata(dirMedium, jobID):
+    """Generate file-level metadata according to fiwalkPolicy. If the policy
+    is 'auto', fiwalk is only run if Aaru's sidecar doesn't describe all
+    files on the medium. Returns True on success"""
+    if config.fiwalkPolicy == "never":
+        logging.info('*** Skipping fiwalk (fiwalkPolicy is never) ***')
+        return True
+
+    if config.fiwalkPolicy == "auto" and config.imagingApplication == "aaru":
+        sidecarFile = os.path.join(dirMedium, jobID + '.cicm.xml')
+        try:
+            partitions = sidecar.readSidecar(sidecarFile)
+            reason = sidecar.fiwalkReason(partitions)
+            logging.info(''.join(['Aaru sidecar: ', sidecar.summary(partitions)]))
+        except (OSError, ETree.ParseError):
+            reason = 'cannot read sidecar ' + sidecarFile
+        if reason is None:
+            logging.info('*** Skipping fiwalk, all files are described in Aaru sidecar ***')
+            return True
+        logging.info(''.join(['running fiwalk: ', reason]))
+
+    return generateDfxml(dirMedium, jobID)
+
+
+def fetchMetadata(PPN, dirMedium):
+    """Fetch metadata from KBMDO and store as file, return True on success"""
+    logging.info('*** Writing metadata from KB-MDO to file ***')
 
-    if config.enablePPNLookup:
-        # Fetch metadata from KBMDO and store as file
-        logging.info('*** Writing metadata from KB-MDO to file ***')
+    successMdoWrite = mdo.writeMDORecord(PPN, dirMedium)
+    if not successMdoWrite:
+        logging.error("Could not write metadata from KB-MDO")
+    return successMdoWrite
 
-        successMdoWrite = mdo.writeMDORecord(PPN, dirMedium)
-        if not successMdoWrite:
+
+def postProcess(carrierData, resultImaging):
+    """Run all post-imaging stages on the image of one medium/carrier, and
+    add an entry to the batch manifest. These stages don't need the drive,
+    so the medium can already be removed"""
+
+    jobID = carrierData['jobID']
+    PPN = carrierData['PPN']
+    dirMedium = resultImaging["dirMedium"]
+    success = resultImaging["success"]
+
+    # Fetch metadata from KBMDO while fiwalk is running
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if config.enablePPNLookup:
+            futureMdo = pool.submit(fetchMetadata, PPN, dirMedium)
+
+        if not generateFileMetadata(dirMedium, jobID):
+            success = False
+
+        if config.enablePPNLookup and not futureMdo.result():
             success = False
-            logging.error("Could not write metadata from KB-MDO")
 
     # Generate checksum file
     logging.info('*** Computing checksums ***')
-    successChecksum = checksumDirectory(dirMedium)
+    successChecksum = checksums.checksumDirectory(dirMedium, config.checksumAlgorithms,
+                                                   resultImaging["knownChecksums"],
+                                                   config.hashWorkers,
+                                                   config.treeHashChunkSize)
 
     if not successChecksum:
         success = False
@@ -170,22 +199,34 @@ def processMedium(carrierData):
                          carrierData['volumeNo'],
                          carrierData['title'],
                          str(success),
-                         str(readErrors),
-                         str(badBlocks)])
+                         str(resultImaging["readErrors"]),
+                         str(resultImaging["badBlocks"])])
+
+    # Add ddrescue map statistics (empty for Aaru)
+    mapStatistics = resultImaging["mapStatistics"]
+    for column in manifest.MAP_STATISTICS:
+        if mapStatistics is not None:
+            rowBatchManifest.append(str(mapStatistics[column]))
+        else:
+            rowBatchManifest.append('')
 
-    # Open batch manifest in append mode
-    bm = open(config.batchManifest, "a", encoding="utf-8")
+    # Add sectors that Aaru could not read (empty for ddrescue)
+    badSectorRanges = resultImaging["badSectorRanges"]
+    if badSectorRanges is not None:
+        rowBatchManifest.append(str(sum(last - first + 1 for first, last in badSectorRanges)))
+        rowBatchManifest.append(aaru.formatRanges(badSectorRanges))
+    else:
+        rowBatchManifest += ['', '']
 
-    # Create CSV writer object
-    csvBm = csv.writer(bm, lineterminator='\n')
+    # Write row to batch manifest
+    manifest.addRow(rowBatchManifest)
 
-    # Write row to batch manifest and close file
-    csvBm.writerow(rowBatchManifest)
-    bm.close()
+    logging.info(''.join(['*** Finished processing job ', jobID, ' ***']))
 
-    logging.info('*** Finished processing medium ***')
+    return success
 
-    # Set finishedMedium flag
-    config.finishedMedium = True
 
-    return success
\ No newline at end of file
+def processMedium(carrierData, drive):
+    """Process one medium/carrier in drive (all stages in sequence)"""
+    resultImaging = imageMedium(carrierData, drive)
+    return postProcess(carrierData, resultImaging)
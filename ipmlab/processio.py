@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+"""Helper functions for reading the output of external tools, and for
+waiting for the files they write"""
+
+import os
+import re
+import time
+import selectors
+
+# Size of chunks that are read from pipes
+CHUNKSIZE = 2**16
+
+# ANSI escape sequences (e.g. cursor movements)
+ANSI_ESCAPE = re.compile(rb'\x1b\[[0-9;?]*[A-Za-z]')
+
+# Line delimiters (tools that report progress use carriage returns)
+LINE_DELIMITER = re.compile(rb'[\r\n]')
+
+# Interval (in seconds) at which waitForFile checks for the file
+POLL_INTERVAL = 0.1
+
+
+class lineSplitter():
+    """Incrementally splits chunks of bytes into lines, and strips ANSI
+    escape sequences from them"""
+
+    def __init__(self):
+        """Initiate class"""
+        self.partial = b''
+
+    def feed(self, data):
+        """Add data, and return list of all lines that were completed by it"""
+        items = LINE_DELIMITER.split(self.partial + data)
+        # Last item is either an empty string or an incomplete line
+        self.partial = items.pop()
+        return [self.tidy(item) for item in items if item]
+
+    def flush(self):
+        """Return remaining incomplete line as list"""
+        items = [self.tidy(self.partial)] if self.partial else []
+        self.partial = b''
+        return items
+
+    def tidy(self, line):
+        """Strip ANSI escape sequences and decode to string"""
+        return ANSI_ESCAPE.sub(b'', line).decode('utf-8', errors='replace')
+
+
+def readStreams(p, onStdout, onStderr, interval=None, onInterval=None):
+    """Read stdout and stderr of process p in large chunks until both pipes
+    are closed, and pass each line to the onStdout and onStderr functions.
+    Both pipes are drained, so the process never blocks on a full pipe.
+    If interval is set, onInterval is called every interval seconds"""
+
+    handlers = {p.stdout.fileno(): (lineSplitter(), onStdout),
+                p.stderr.fileno(): (lineSplitter(), onStderr)}
+
+    with selectors.DefaultSelector() as sel:
+        for fd in handlers:
+            sel.register(fd, selectors.EVENT_READ)
+
+        nextTime = time.monotonic() + interval if interval else None
+        while handlers:
+            timeout = None
+            if nextTime is not None:
+                timeout = max(nextTime - time.monotonic(), 0)
+            for key, _ in sel.select(timeout):
+                fd = key.fd
+                splitter, handler = handlers[fd]
+                data = os.read(fd, CHUNKSIZE)
+                if data:
+                    lines = splitter.feed(data)
+                else:
+                    # Pipe closed
+                    lines = splitter.flush()
+                    sel.unregister(fd)
+                    del handlers[fd]
+                for line in lines:
+                    handler(line)
+            if nextTime is not None and time.monotonic() >= nextTime:
+                nextTime = time.monotonic() + interval
+                onInterval()
+
+
+def waitForFile(fileName, timeout):
+    """Wait until fileName exists, for at most timeout seconds. Returns
+    True if the file exists, False otherwise. Only use this after the
+    process that writes the file has exited; the file normally exists
+    already, in which case this returns immediately"""
+
+    deadline = time.monotonic() + timeout
+    while not os.path.isfile(fileName):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
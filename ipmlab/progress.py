@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+"""Progress reporting for imaging applications"""
+
+import os
+import time
+import logging
+
+# Minimum interval (in seconds) between progress events
+EVENT_INTERVAL = 0.5
+
+
+class progressReporter():
+    """Turns progress updates from an imaging application into progress
+    events, which are dictionaries with the following items:
+
+    - jobID, device
+    - bytesRescued, totalSize (bytes)
+    - percent
+    - currentRate, averageRate (bytes per second)
+    - eta (seconds)
+
+    Values that the imaging application doesn't report (e.g. rates) are
+    computed from the updates. Events are passed to onEvent at most every
+    EVENT_INTERVAL seconds, and written to the log every logInterval seconds
+    """
+
+    def __init__(self, jobID, device, onEvent=None, logInterval=30):
+        """Initiate class"""
+        self.jobID = jobID
+        self.device = device
+        self.onEvent = onEvent
+        self.logInterval = logInterval
+        self.totalSize = getDeviceSize(device)
+        self.startTime = time.monotonic()
+        self.lastUpdate = (self.startTime, 0)
+        self.lastEventTime = 0
+        self.lastLogTime = self.startTime
+        self.currentRate = None
+        self.event = None
+
+    def update(self, bytesRescued, totalSize=None, currentRate=None,
+               averageRate=None, eta=None, final=False):
+        """Process progress update. If final is True the event is always
+        passed on (use this for the last update)"""
+        now = time.monotonic()
+
+        if totalSize:
+            self.totalSize = totalSize
+
+        # Compute current rate from previous update if not reported
+        if currentRate is None:
+            lastTime, lastBytes = self.lastUpdate
+            if now > lastTime:
+                currentRate = int((bytesRescued - lastBytes) / (now - lastTime))
+        self.lastUpdate = (now, bytesRescued)
+
+        if averageRate is None and now > self.startTime:
+            averageRate = int(bytesRescued / (now - self.startTime))
+
+        if self.totalSize:
+            percent = min(100.0, 100.0 * bytesRescued / self.totalSize)
+            if eta is None and averageRate:
+                eta = int(max(self.totalSize - bytesRescued, 0) / averageRate)
+        else:
+            percent = None
+
+        self.event = {'jobID': self.jobID,
+                      'device': self.device,
+                      'bytesRescued': bytesRescued,
+                      'totalSize': self.totalSize,
+                      'percent': percent,
+                      'currentRate': currentRate,
+                      'averageRate': averageRate,
+                      'eta': eta}
+
+        if self.onEvent is not None and (final or now - self.lastEventTime >= EVENT_INTERVAL):
+            self.lastEventTime = now
+            self.onEvent(self.event)
+
+        if final or now - self.lastLogTime >= self.logInterval:
+            self.lastLogTime = now
+            logging.info(''.join(['progress ', self.device, ': ', formatEvent(self.event)]))
+
+
+def getDeviceSize(device):
+    """Return size of device in bytes, or None if it cannot be determined"""
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            return os.lseek(fd, 0, os.SEEK_END) or None
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+
+
+def formatSize(noBytes):
+    """Return human-readable representation of size in bytes"""
+    if noBytes is None:
+        return 'n/a'
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(noBytes) < 1000:
+            return '{:.4g} {}'.format(noBytes, unit)
+        noBytes /= 1000
+    return '{:.4g} TB'.format(noBytes)
+
+
+def formatDuration(seconds):
+    """Return human-readable representation of duration in seconds"""
+    if seconds is None:
+        return 'n/a'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h {}m {}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{}m {}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+def formatEvent(event):
+    """Return human-readable summary of progress event"""
+    if event['percent'] is None:
+        percent = ''
+    else:
+        percent = ' ({:.1f}%)'.format(event['percent'])
+    return ''.join([formatSize(event['bytesRescued']), ' of ',
+                    formatSize(event['totalSize']), percent, ', ',
+                    formatSize(event['currentRate']), '/s (average ',
+                    formatSize(event['averageRate']), '/s), ETA ',
+                    formatDuration(event['eta'])])
@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+"""Job queue and scheduler
+
+Carriers are submitted as jobs to a queue that is consumed by one worker
+thread per drive. A worker only images the medium; as soon as imaging is
+done the drive is released, and the post-imaging stages are run by a
+separate pool of threads. Everything that needs operator interaction (loading and
+removing media) goes through a frontend object, and callbacks that must run
+on the frontend's (e.g. Tk) thread are posted to a callback queue.
+"""
+
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import pmworker
+from . import manifest
+
+# Job states after which a job needs no more processing
+DONE = ['finished', 'failed', 'cancelled']
+
+
+class job():
+    """One carrier that is to be processed"""
+
+    def __init__(self, carrierData):
+        """Initiate class"""
+        self.carrierData = carrierData
+        self.jobID = carrierData['jobID']
+        # One of 'queued', 'loading', 'imaging', 'post-processing', 'finished',
+        # 'failed' (imaging or post-processing raised an error, no manifest
+        # entry was written), 'cancelled'
+        self.status = 'queued'
+        self.drive = None
+        # Most recent progress event
+        self.progress = None
+        # Completion future, result is the success status of the job
+        self.future = Future()
+
+
+class scheduler():
+    """Distributes queued jobs over one worker thread per drive
+
+    The frontend must provide the following methods, which are called from
+    the worker threads:
+
+    - loadMedium(job): ask the operator to load the medium of job into
+      job.drive; return True when loaded, or False to cancel the job
+    - removeMedium(job): ask the operator to remove the medium from
+      job.drive; return after it has been removed
+    - jobUpdated(job, status): called (on the frontend thread) whenever the
+      status of job changes. Status is the new status; job.status may
+      already have changed again by the time the callback runs
+    - progressUpdated(job, event): called (on the frontend thread) with
+      progress events during imaging (see progress.progressReporter)
+    """
+
+    def __init__(self, drives, frontend):
+        """Initiate class"""
+        self.drives = drives
+        self.frontend = frontend
+        self.jobQueue = queue.Queue()
+        self.callbackQueue = queue.Queue()
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.idleCallbacks = []
+        self.stoppedCallbacks = []
+        self.noWorkers = 0
+        # Number of drives that are loading, imaging or waiting for removal
+        self.noBusyDrives = 0
+        self.stopping = False
+        # Pool that runs post-imaging stages
+        self.pipeline = ThreadPoolExecutor(max_workers=max(2*len(drives), 2))
+
+    def start(self):
+        """Start one worker thread for each drive"""
+        for drive in self.drives:
+            drive.thread = threading.Thread(target=self.work, args=[drive],
+                                            name=drive.device, daemon=True)
+            self.noWorkers += 1
+            drive.thread.start()
+
+    def submit(self, job):
+        """Add job to the queue"""
+        with self.lock:
+            self.jobs.append(job)
+        if manifest.index is not None:
+            manifest.index.addJob(job.carrierData)
+        self.jobQueue.put(job)
+        self.post(self.frontend.jobUpdated, job, 'queued')
+        return job
+
+    def cancel(self, jobID):
+        """Cancel job if it is not being processed yet, and return True if
+        it was cancelled"""
+        cancelledJob = None
+        with self.lock:
+            for job in self.jobs:
+                if job.jobID == jobID and job.status == 'queued':
+                    job.status = 'cancelled'
+                    job.future.cancel()
+                    cancelledJob = job
+        if cancelledJob is not None:
+            self.statusChanged(cancelledJob, 'cancelled')
+            self.checkIdle()
+        return cancelledJob is not None
+
+    def queuedJobs(self):
+        """Return list of jobs that are waiting for a drive"""
+        with self.lock:
+            return [j for j in self.jobs if j.status == 'queued']
+
+    def activeJobs(self):
+        """Return list of jobs that are queued or being processed"""
+        with self.lock:
+            return [j for j in self.jobs if j.status not in DONE]
+
+    def findJob(self, jobID):
+        """Return job with jobID, or None if it was not submitted to this scheduler"""
+        with self.lock:
+            for j in self.jobs:
+                if j.jobID == jobID:
+                    return j
+        return None
+
+    def isIdle(self):
+        """Return True if no jobs are queued or being processed"""
+        with self.lock:
+            return (self.noBusyDrives == 0 and
+                    all(j.status in DONE for j in self.jobs))
+
+    def post(self, callback, *args):
+        """Post callback to the frontend thread"""
+        self.callbackQueue.put((callback, args))
+
+    def runCallbacks(self):
+        """Run all pending callbacks. Must be called from the frontend thread"""
+        while True:
+            try:
+                callback, args = self.callbackQueue.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+
+    def callOnFrontend(self, function, *args):
+        """Run function on the frontend thread, wait for it to finish
+        and return its result. Used for operator dialogs"""
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.post(run)
+        return future.result()
+
+    def whenIdle(self, callback):
+        """Post callback to the frontend thread once all queued jobs have been
+        processed"""
+        with self.lock:
+            self.idleCallbacks.append(callback)
+        self.checkIdle()
+
+    def checkIdle(self):
+        """Post idle callbacks if there is no more work"""
+        if self.isIdle():
+            with self.lock:
+                callbacks = self.idleCallbacks
+                self.idleCallbacks = []
+            for callback in callbacks:
+                self.post(callback)
+
+    def shutdown(self, callback):
+        """Stop workers after they have finished their current job. Jobs
+        that are still queued are not processed. Callback is posted to the
+        frontend thread once all workers have stopped"""
+        with self.lock:
+            self.stopping = True
+            self.stoppedCallbacks.append(callback)
+            noWorkers = self.noWorkers
+        for job in self.queuedJobs():
+            logging.warning(''.join(['Job ', job.jobID, ' was not processed']))
+        if noWorkers == 0:
+            self.post(callback)
+        for _ in range(noWorkers):
+            # Sentinel, tells worker to stop
+            self.jobQueue.put(None)
+
+    def setStatus(self, job, status):
+        """Update status of job"""
+        job.status = status
+        self.statusChanged(job, status)
+
+    def statusChanged(self, job, status):
+        """Store new status of job in batch index, and notify frontend"""
+        if manifest.index is not None:
+            manifest.index.setStatus(job.jobID, status)
+        self.post(self.frontend.jobUpdated, job, status)
+
+    def work(self, drive):
+        """Worker that processes jobs in drive"""
+        while True:
+            job = self.jobQueue.get()
+            if job is None or self.stopping:
+                break
+            with self.lock:
+                if job.status == 'cancelled':
+                    continue
+                job.status = 'loading'
+                self.noBusyDrives += 1
+
+            job.drive = drive
+            self.statusChanged(job, 'loading')
+
+            if not self.frontend.loadMedium(job):
+                self.setStatus(job, 'cancelled')
+                job.future.cancel()
+            else:
+                self.setStatus(job, 'imaging')
+                try:
+                    resultImaging = pmworker.imageMedium(job.carrierData, drive,
+                                                         lambda event: self.progress(job, event))
+                except Exception:
+                    logging.exception(''.join(['Imaging of job ', job.jobID, ' failed']))
+                    resultImaging = None
+                if resultImaging is None:
+                    job.future.set_result(False)
+                    self.setStatus(job, 'failed')
+                else:
+                    # Start post-imaging stages before the medium is removed,
+                    # so they don't wait for the operator
+                    self.setStatus(job, 'post-processing')
+                    self.pipeline.submit(self.postProcess, job, resultImaging)
+                self.frontend.removeMedium(job)
+
+            with self.lock:
+                self.noBusyDrives -= 1
+            self.checkIdle()
+
+        with self.lock:
+            self.noWorkers -= 1
+            lastWorker = self.noWorkers == 0
+        if lastWorker:
+            # Wait until post-imaging stages of all jobs are done
+            self.pipeline.shutdown(wait=True)
+            with self.lock:
+                callbacks = self.stoppedCallbacks
+                self.stoppedCallbacks = []
+            for callback in callbacks:
+                self.post(callback)
+
+    def progress(self, job, event):
+        """Store progress event of job and pass it on to the frontend"""
+        job.progress = event
+        self.post(self.frontend.progressUpdated, job, event)
+
+    def postProcess(self, job, resultImaging):
+        """Run post-imaging stages of job"""
+        try:
+            success = pmworker.postProcess(job.carrierData, resultImaging)
+            status = 'finished'
+        except Exception:
+            logging.exception(''.join(['Post-processing of job ', job.jobID, ' failed']))
+            success = False
+            status = 'failed'
+        job.future.set_result(success)
+        self.setStatus(job, status)
+        self.checkIdle()
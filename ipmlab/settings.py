@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+"""Read configuration file into config.py, and check the configuration.
+This module doesn't depend on Tkinter, so it can be used by both the
+graphical and the headless frontend"""
+
+import os
+import xml.etree.ElementTree as ETree
+from . import config
+from . import checksums
+from . import drives
+from .kbapi.sru import setCache, configureSession
+from .kbapi.cache import responseCache
+
+# Attributes of inDevice elements that override the ddrescue retry budget
+# for one drive
+RETRY_BUDGET = ('retries', 'retryPasses', 'retryTime')
+
+
+def representsInt(s):
+    """Return True if s is an integer, False otherwise"""
+    # Source: http://stackoverflow.com/a/1267145
+    try:
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+
+def findElementText(elt, elementPath):
+    """Returns element text if it exists, empty string if it doesn't exist"""
+    elementText = elt.findtext(elementPath)
+    if elementText is None:
+        elementText = ""
+    return elementText
+
+
+def getConfiguration():
+    """ Read configuration file, make all config variables available via
+    config.py and check that all file paths / executables exist.
+    This assumes an non-frozen script (no Py2Exe!)
+    """
+
+    configFileDefinedFlag = False
+    configFileExistsFlag = False
+    configFileOpenFlag = False
+    configFileParsedFlag = False
+
+    packageDir = os.path.dirname(os.path.abspath(__file__))
+    homeDir = os.path.normpath(os.path.expanduser("~"))
+    if packageDir.startswith(homeDir):
+        configFileUser = os.path.join(homeDir, '.config/ipmlab/config.xml')
+    else:
+        configFileUser = os.path.normpath('/etc/ipmlab/config.xml')
+    configFileDefinedFlag = True
+
+    # Check if user config file exists and exit if not
+    if os.path.isfile(configFileUser):
+        configFileExistsFlag = True
+
+    # Read contents to bytes object
+    if configFileExistsFlag:
+        try:
+            fConfig = open(configFileUser, "rb")
+            configBytes = fConfig.read()
+            fConfig.close()
+            configFileOpenFlag = True
+        except IOError:
+            pass
+
+    # Parse XML tree
+    if configFileOpenFlag:
+        try:
+            root = ETree.fromstring(configBytes)
+            configFileParsedFlag = True
+        except Exception:
+            pass
+
+    if configFileParsedFlag:
+
+        # Create empty element object & add config contents to it
+        # A bit silly but allows use of findElementText in etpatch
+
+        configElt = ETree.Element("bogus")
+        configElt.append(root)
+
+        config.inDevices = drives.parseDevices([elt.text or "" for elt in
+                                                configElt.findall('./config/inDevice')])
+        # Retry budgets of ddrescue that are defined for individual drives
+        # (attributes of inDevice elements)
+        config.retryBudgets = {}
+        for elt in configElt.findall('./config/inDevice'):
+            budget = {}
+            for attribute in RETRY_BUDGET:
+                value = elt.get(attribute)
+                if value is not None:
+                    budget[attribute] = int(value) if representsInt(value) else -1
+            for inDevice in drives.parseDevices([elt.text or ""]):
+                config.retryBudgets[inDevice] = budget
+        config.rootDir = findElementText(configElt, './config/rootDir')
+        config.prefixBatch = findElementText(configElt, './config/prefixBatch')
+        config.fiwalkBin = findElementText(configElt, './config/fiwalkBin')
+        fiwalkPolicy = findElementText(configElt, './config/fiwalkPolicy')
+        if fiwalkPolicy != "":
+            config.fiwalkPolicy = fiwalkPolicy
+        config.imagingApplication = findElementText(configElt, './config/imagingApplication')
+        config.aaruBin = findElementText(configElt, './config/aaruBin')
+        config.ddrescueBin = findElementText(configElt, './config/ddrescueBin')
+        config.blockSize = findElementText(configElt, './config/blockSize')
+        config.retries = findElementText(configElt, './config/retries')
+        retryPasses = findElementText(configElt, './config/retryPasses')
+        if retryPasses != "":
+            config.retryPasses = int(retryPasses) if representsInt(retryPasses) else -1
+        retryTime = findElementText(configElt, './config/retryTime')
+        if retryTime != "":
+            config.retryTime = int(retryTime) if representsInt(retryTime) else -1
+    
+        # For below configuration variables, use default value if value cannot be
+        # read from config file (this ensures v1 will work with old config files)
+        try:
+            config.socketHost = findElementText(configElt, './config/socketHost')
+        except:
+            pass
+        try:
+            config.socketPort = findElementText(configElt, './config/socketPort')
+        except:
+            pass
+        try:
+            if findElementText(configElt, './config/enablePPNLookup') == "True":
+                config.enablePPNLookup = True
+            else:
+                config.enablePPNLookup = False
+        except:
+            pass
+        try:
+            if findElementText(configElt, './config/enableSocketAPI') == "True":
+                config.enableSocketAPI = True
+            else:
+                config.enableSocketAPI = False
+        except:
+            pass
+        if findElementText(configElt, './config/inlineHashing') == "True":
+            config.inlineHashing = True
+        if findElementText(configElt, './config/sparseImages') == "True":
+            config.sparseImages = True
+        hashWorkers = findElementText(configElt, './config/hashWorkers')
+        if hashWorkers != "":
+            config.hashWorkers = int(hashWorkers) if representsInt(hashWorkers) else 0
+        secondsToTimeout = findElementText(configElt, './config/secondsToTimeout')
+        if representsInt(secondsToTimeout):
+            config.secondsToTimeout = int(secondsToTimeout)
+        progressLogInterval = findElementText(configElt, './config/progressLogInterval')
+        if representsInt(progressLogInterval):
+            config.progressLogInterval = int(progressLogInterval)
+        treeHashChunkSize = findElementText(configElt, './config/treeHashChunkSize')
+        if treeHashChunkSize != "":
+            config.treeHashChunkSize = int(treeHashChunkSize) if representsInt(treeHashChunkSize) else -1
+        sruCacheDir = findElementText(configElt, './config/sruCacheDir')
+        if sruCacheDir != "":
+            config.sruCacheDir = os.path.normpath(os.path.expanduser(sruCacheDir))
+        else:
+            config.sruCacheDir = os.path.join(homeDir, '.cache/ipmlab/sru')
+        sruCacheTTL = findElementText(configElt, './config/sruCacheTTL')
+        if sruCacheTTL != "":
+            config.sruCacheTTL = int(sruCacheTTL) if representsInt(sruCacheTTL) else -1
+        sruCacheSize = findElementText(configElt, './config/sruCacheSize')
+        if sruCacheSize != "":
+            config.sruCacheSize = int(sruCacheSize) if representsInt(sruCacheSize) else -1
+        sruConnectTimeout = findElementText(configElt, './config/sruConnectTimeout')
+        if sruConnectTimeout != "":
+            config.sruConnectTimeout = int(sruConnectTimeout) if representsInt(sruConnectTimeout) else -1
+        sruReadTimeout = findElementText(configElt, './config/sruReadTimeout')
+        if sruReadTimeout != "":
+            config.sruReadTimeout = int(sruReadTimeout) if representsInt(sruReadTimeout) else -1
+        sruRetries = findElementText(configElt, './config/sruRetries')
+        if sruRetries != "":
+            config.sruRetries = int(sruRetries) if representsInt(sruRetries) else -1
+        checksumAlgorithms = findElementText(configElt, './config/checksumAlgorithms')
+        if checksumAlgorithms != "":
+            try:
+                config.checksumAlgorithms = checksums.parseAlgorithms(checksumAlgorithms)
+            except ValueError:
+                config.checksumAlgorithms = []
+
+        # Normalise all file paths
+        config.rootDir = os.path.normpath(config.rootDir)
+        config.fiwalkBin = os.path.normpath(config.fiwalkBin)
+        config.aaruBin = os.path.normpath(config.aaruBin)
+        config.ddrescueBin = os.path.normpath(config.ddrescueBin)
+
+    return configFileDefinedFlag, configFileExistsFlag, configFileOpenFlag, configFileParsedFlag
+
+
+def checkConfiguration(configFileDefinedFlag, configFileExistsFlag,
+                       configFileOpenFlag, configFileParsedFlag):
+    """Check configuration (flags are the result of getConfiguration), and
+    set up catalogue lookups. Returns error message if the configuration is
+    invalid, and None otherwise"""
+
+    # Config file is either undefined, doesn't exist, cannot be opened or
+    # cannot be parsed
+
+    if not configFileDefinedFlag:
+        msg = "configuration file is undefined"
+        return msg
+    if not configFileExistsFlag:
+        msg = "configuration file doesn't exist"
+        return msg
+    if not configFileOpenFlag:
+        msg = "configuration file cannot be opened"
+        return msg
+    if not configFileParsedFlag:
+        msg = "unable to parse configuration file"
+        return msg
+
+    # Check if all needed binaries exist, and return error if not
+    if config.fiwalkPolicy not in ["always", "auto", "never"]:
+        msg = config.fiwalkPolicy + " is not a recognized fiwalkPolicy value"
+        return msg
+    if config.fiwalkPolicy != "never" and not os.path.isfile(config.fiwalkBin):
+        msg = "Fiwalk binary " + config.fiwalkBin + " does not exist"
+        return msg
+    if config.imagingApplication == "aaru":
+        if not os.path.isfile(config.aaruBin):
+            msg = "Aaru binary " + config.aaruBin + " does not exist"
+            return msg
+    elif config.imagingApplication == "ddrescue":
+        if not os.path.isfile(config.ddrescueBin):
+            msg = "Ddrescue binary " + config.ddrescueBin + " does not exist"
+            return msg
+    else:
+        msg = config.imagingApplication + " is not a recognized imagingApplication value"
+        return msg
+
+    # Check if ddrescue retry budgets are valid, and return error if not
+    retries = int(config.retries) if representsInt(config.retries) else -1
+    for budget in [{'retries': retries, 'retryPasses': config.retryPasses,
+                    'retryTime': config.retryTime}] + list(config.retryBudgets.values()):
+        if min(budget.values(), default=0) < 0:
+            msg = "retries, retryPasses and retryTime must be integer values greater than or equal to 0"
+            return msg
+
+    # Check if checksum algorithms are valid, and return error if not
+    if not config.checksumAlgorithms:
+        msg = "checksumAlgorithms contains unsupported or no algorithms"
+        return msg
+    if config.hashWorkers < 1:
+        msg = "hashWorkers must be an integer value greater than or equal to 1"
+        return msg
+    if config.treeHashChunkSize < 0:
+        msg = "treeHashChunkSize must be an integer value greater than or equal to 0"
+        return msg
+    if config.sruCacheTTL < 0 or config.sruCacheSize < 0:
+        msg = "sruCacheTTL and sruCacheSize must be integer values greater than or equal to 0"
+        return msg
+
+    # Set up cache for catalogue lookups, and return error if cache directory
+    # cannot be created
+    try:
+        setCache(responseCache(config.sruCacheDir,
+                               ttl=3600*config.sruCacheTTL,
+                               maxDiskSize=config.sruCacheSize*2**20))
+    except OSError:
+        msg = "cannot create SRU cache directory " + config.sruCacheDir
+        return msg
+
+    # Set timeouts and retries of catalogue lookups
+    if config.sruConnectTimeout < 1 or config.sruReadTimeout < 1 or config.sruRetries < 0:
+        msg = ("sruConnectTimeout and sruReadTimeout must be integer values greater than "
+               "or equal to 1, and sruRetries greater than or equal to 0")
+        return msg
+    configureSession(config.sruConnectTimeout, config.sruReadTimeout, config.sruRetries)
+
+    # Check if root dir exists, and return error if not
+    if not os.path.isdir(config.rootDir):
+        msg = "root directory " + config.rootDir + " does not exist"
+        return msg
+
+    # Check if input devices exist, and return error if not
+    if not config.inDevices:
+        msg = "no inDevice defined"
+        return msg
+    for inDevice in config.inDevices:
+        try:
+            os.stat(inDevice)
+        except OSError:
+            msg = "inDevice " + inDevice + " does not exist"
+            return msg
+
+    return None
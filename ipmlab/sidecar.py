@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+"""Reading of the CICM metadata sidecar that Aaru writes (with --metadata),
+which describes the partitions and file systems of the medium, and (for file
+systems that Aaru can read) all files on them"""
+
+import xml.etree.ElementTree as ETree
+
+
+def readSidecar(sidecarFile):
+    """Parse sidecar incrementally, and return list of partitions. Each
+    partition is a dictionary with a type and a list of file systems; each
+    file system is a dictionary with a type, a hasContents flag (True if the
+    sidecar lists the contents of the file system) and the number of files"""
+
+    partitions = []
+    path = []
+    for event, elem in ETree.iterparse(sidecarFile, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            parent = path[-1] if path else None
+            path.append(tag)
+            if tag == 'Partition' and parent == 'FileSystemInformation':
+                partitions.append({'type': '', 'fileSystems': []})
+            elif tag == 'FileSystem' and parent == 'FileSystems' and partitions:
+                partitions[-1]['fileSystems'].append({'type': '',
+                                                      'hasContents': False,
+                                                      'noFiles': 0})
+            elif tag == 'Contents' and parent == 'FileSystem' and partitions:
+                partitions[-1]['fileSystems'][-1]['hasContents'] = True
+            continue
+
+        path.pop()
+        parent = path[-1] if path else None
+        if 'Contents' in path:
+            # File listing, which can be large: count files, and free memory
+            if tag == 'File' and partitions:
+                partitions[-1]['fileSystems'][-1]['noFiles'] += 1
+            elem.clear()
+        elif tag == 'Type' and parent == 'Partition' and partitions:
+            partitions[-1]['type'] = (elem.text or '').strip()
+        elif tag == 'Type' and parent == 'FileSystem' and partitions:
+            partitions[-1]['fileSystems'][-1]['type'] = (elem.text or '').strip()
+        elif tag == 'Partition':
+            elem.clear()
+
+    return partitions
+
+
+def fiwalkReason(partitions):
+    """Return reason why fiwalk is needed for medium with partitions (result
+    of readSidecar), or None if the sidecar describes all of its files"""
+
+    if not partitions:
+        return 'sidecar does not describe any partitions'
+    for i, partition in enumerate(partitions):
+        if not partition['fileSystems']:
+            return ''.join(['no file system found in partition ', str(i)])
+        for fileSystem in partition['fileSystems']:
+            if not fileSystem['hasContents']:
+                return ''.join(['contents of ', fileSystem['type'] or 'unknown',
+                                ' file system in partition ', str(i),
+                                ' not in sidecar'])
+    return None
+
+
+def summary(partitions):
+    """Return summary of partitions (result of readSidecar) as string"""
+    items = []
+    for i, partition in enumerate(partitions):
+        fileSystems = [''.join([fileSystem['type'] or 'unknown', ' (',
+                                str(fileSystem['noFiles']), ' files)'])
+                       for fileSystem in partition['fileSystems']]
+        items.append(''.join(['partition ', str(i), ': ',
+                              ', '.join(fileSystems) or 'no file system']))
+    return '; '.join(items)
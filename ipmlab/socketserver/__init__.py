@@ -1 +1 @@
-from .server import server
+from .server import server, messageQueue
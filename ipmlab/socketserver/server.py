@@ -3,58 +3,296 @@
 Simple socket communication server
 Adapted from https://medium.com/python-pandemonium/python-socket-communication-e10b39225a4c
 Original code by Rodgers Ouma Mc'Alila
-""" 
 
-import sys
+The server handles any number of clients at the same time. Each client
+can send multiple messages over one connection, separated by newlines.
+Any data that is left when a client closes the connection is treated as
+a final message (so clients that send one message without newline and then
+close the connection also work).
+
+Received messages are put in the message queue as (clientID, message)
+tuples; when a client closes its connection (or only its sending side),
+(clientID, None) is put in the queue. Replies are sent with
+send(clientID, message). A connection that was closed by the client is kept
+open until finish(clientID) is called (after all replies to the client have
+been sent with send()), and its remaining replies have been written.
+
+If the message queue is a messageQueue, an event loop (e.g. Tk's
+createfilehandler) can watch it for new messages, so there is no need to
+poll it.
+"""
+
 import socket
 import selectors
-import traceback
+import logging
 import queue
+import threading
+
+# Size of chunks that are read from sockets
+CHUNKSIZE = 2**16
+
+# Maximum length of a message; clients that send longer messages are
+# disconnected
+MAX_MESSAGE = 2**20
+
+# Maximum amount of unsent data for a client; clients that don't read their
+# replies (fast enough) are disconnected
+MAX_OUTPUT = 2**24
+
+
+class messageQueue(queue.Queue):
+    """Queue with a file descriptor that becomes readable whenever an item
+    is put in it"""
+
+    def __init__(self):
+        """Initiate class"""
+        queue.Queue.__init__(self)
+        self.receiver, self.sender = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.sender.setblocking(False)
+
+    def put(self, item, block=True, timeout=None):
+        """Put item in queue, and notify watchers"""
+        queue.Queue.put(self, item, block, timeout)
+        try:
+            self.sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Notification is still pending, or queue was closed
+            pass
+
+    def fileno(self):
+        """Return file descriptor that can be watched for new items"""
+        return self.receiver.fileno()
+
+    def clearNotifications(self):
+        """Clear pending notifications. Call this before getting the items
+        from the queue, so no notifications are lost"""
+        try:
+            while self.receiver.recv(CHUNKSIZE):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        """Close file descriptors"""
+        self.receiver.close()
+        self.sender.close()
+
 
 class server():
 
+    def __init__(self):
+        """Initiate class"""
+        self.sel = selectors.DefaultSelector()
+        # Socket pair that is used to wake up the selector on stop() and send()
+        self.wakeupReceiver, self.wakeupSender = socket.socketpair()
+        self.wakeupReceiver.setblocking(False)
+        self.wakeupSender.setblocking(False)
+        self.stopping = False
+        self.messageQueue = None
+        self.clients = {}
+        self.noClients = 0
+        # Messages that are waiting to be passed to the server thread
+        self.outgoing = []
+        self.lock = threading.Lock()
+
     def start(self, host, port, messageQueue):
-        """Start server"""
+        """Start server, and put all received messages in messageQueue.
+        Returns after stop() is called"""
+        self.messageQueue = messageQueue
         # Create a TCP/IP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         # Bind the socket to the port
         server_address = (host, int(port))
-        print('Starting up on {} port {}'.format(*server_address))
+        logging.info('socket API listening on {} port {}'.format(*server_address))
         sock.bind(server_address)
 
         # Listen for incoming connections
-        sock.listen(1)
-
-        while True:
-            # Wait for a connection
-            print('waiting for a connection')
-            connection, client_address = sock.accept()
-            try:
-                print('connection from', client_address)
-                myBytes = b''
-                # Receive the data in small chunks and retransmit it
-                while True:
-                    data = connection.recv(16)
-                    myBytes += data
-                    if data:
-                        # print('sending data back to the client')
-                        connection.sendall(data)
-                    else:
-                        # print('no data from', client_address)
-                        break
-            finally:
-                # Decode data to string, and submit it to the queue
-                myString = myBytes.decode('utf-8')
-                messageQueue.put(myString)
-                print("Closing current connection")
-                connection.close()
+        sock.listen()
+        sock.setblocking(False)
+
+        self.sel.register(sock, selectors.EVENT_READ, data=None)
+        self.sel.register(self.wakeupReceiver, selectors.EVENT_READ, data=None)
+
+        try:
+            while not self.stopping:
+                for key, mask in self.sel.select():
+                    if key.fileobj is sock:
+                        self.accept(sock)
+                    elif key.fileobj is self.wakeupReceiver:
+                        self.wakeupReceiver.recv(CHUNKSIZE)
+                        self.queueOutgoing()
+                    elif key.data['clientID'] in self.clients:
+                        if mask & selectors.EVENT_WRITE:
+                            self.write(key.data)
+                        if mask & selectors.EVENT_READ and key.data['clientID'] in self.clients:
+                            self.read(key.data)
+        finally:
+            for client in list(self.clients.values()):
+                self.close(client)
+            self.sel.unregister(sock)
+            sock.close()
+            self.sel.close()
+            self.wakeupReceiver.close()
+            self.wakeupSender.close()
+            logging.info('socket API stopped')
+
+    def stop(self):
+        """Stop server (can be called from any thread)"""
+        self.stopping = True
+        self.wakeup()
+
+    def send(self, clientID, message):
+        """Send message (string, a newline is added) to client (can be called
+        from any thread). Messages to clients that are gone are dropped"""
+        with self.lock:
+            self.outgoing.append((clientID, message.encode('utf-8') + b'\n'))
+        self.wakeup()
+
+    def finish(self, clientID):
+        """Close connection of client that closed its side of the connection,
+        after all messages that were sent to it have been written (can be
+        called from any thread)"""
+        with self.lock:
+            self.outgoing.append((clientID, None))
+        self.wakeup()
+
+    def wakeup(self):
+        """Wake up server thread"""
+        try:
+            self.wakeupSender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Server is already awake, or stopped
+            pass
+
+    def accept(self, sock):
+        """Accept new connection"""
+        connection, client_address = sock.accept()
+        logging.debug('socket API: connection from {}'.format(client_address))
+        connection.setblocking(False)
+        self.noClients += 1
+        client = {'clientID': self.noClients,
+                  'connection': connection,
+                  'address': client_address,
+                  'buffer': b'',
+                  'output': b'',
+                  # Selector events the connection is registered for
+                  'events': 0,
+                  # Set if client closed (its side of) the connection
+                  'eof': False,
+                  # Set by finish()
+                  'finished': False}
+        self.clients[client['clientID']] = client
+        self.updateEvents(client)
+
+    def updateEvents(self, client):
+        """Register connection of client for reading (until the client closes
+        its side of the connection) and for writing (if there is output)"""
+        events = 0
+        if not client['eof']:
+            events |= selectors.EVENT_READ
+        if client['output']:
+            events |= selectors.EVENT_WRITE
+        if events == client['events']:
+            return
+        if client['events'] == 0:
+            self.sel.register(client['connection'], events, data=client)
+        elif events == 0:
+            self.sel.unregister(client['connection'])
+        else:
+            self.sel.modify(client['connection'], events, data=client)
+        client['events'] = events
+
+    def read(self, client):
+        """Read data from client, and put all complete messages in messageQueue"""
+        try:
+            data = client['connection'].recv(CHUNKSIZE)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+
+        if data:
+            lines = (client['buffer'] + data).split(b'\n')
+            client['buffer'] = lines.pop()
+            if len(client['buffer']) > MAX_MESSAGE:
+                logging.warning('socket API: message too long, closing connection from {}'.format(client['address']))
+                self.close(client)
+                return
+        else:
+            lines = [client['buffer']]
+            client['buffer'] = b''
+
+        for line in lines:
+            # Decode data to string, and submit it to the queue
+            message = line.decode('utf-8', errors='replace').strip()
+            if message:
+                self.messageQueue.put((client['clientID'], message))
+
+        if not data:
+            # Client closed (its side of) the connection; stop reading, but
+            # keep the connection until all replies have been written
+            client['eof'] = True
+            self.updateEvents(client)
+            self.messageQueue.put((client['clientID'], None))
+
+    def queueOutgoing(self):
+        """Move messages from send() to the output buffers of their clients"""
+        with self.lock:
+            outgoing = self.outgoing
+            self.outgoing = []
+        for clientID, data in outgoing:
+            client = self.clients.get(clientID)
+            if client is None:
+                continue
+            if data is None:
+                client['finished'] = True
+                if not client['output']:
+                    self.close(client)
+                continue
+            if len(client['output']) + len(data) > MAX_OUTPUT:
+                logging.warning('socket API: client not reading replies, closing connection from {}'.format(client['address']))
+                self.close(client)
+                continue
+            client['output'] += data
+            self.updateEvents(client)
+
+    def write(self, client):
+        """Write as much of the output buffer of client as possible"""
+        try:
+            sent = client['connection'].send(client['output'])
+        except BlockingIOError:
+            return
+        except OSError:
+            # Client is gone, drop remaining output
+            client['output'] = b''
+            sent = 0
+        client['output'] = client['output'][sent:]
+        if not client['output'] and client['finished']:
+            self.close(client)
+        else:
+            self.updateEvents(client)
+
+    def close(self, client):
+        """Close connection of client"""
+        logging.debug('socket API: closing connection from {}'.format(client['address']))
+        del self.clients[client['clientID']]
+        if client['events'] != 0:
+            self.sel.unregister(client['connection'])
+        client['connection'].close()
+        if not client['eof']:
+            self.messageQueue.put((client['clientID'], None))
+
 
 def main():
     host = '127.0.0.1'
     port = 65432
+    myQueue = queue.Queue()
     myServer = server()
-    myServer.start(host, port, queue)
+    myServer.start(host, port, myQueue)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
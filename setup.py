@@ -32,7 +32,7 @@ PYTHON_REQUIRES = '>=3.2'
 
 setup(name='ipmlab',
       packages=find_packages(),
-      version=find_version('ipmlab', 'ipmlab.py'),
+      version=find_version('ipmlab', '__init__.py'),
       license='Apache License 2.0',
       install_requires=INSTALL_REQUIRES,
       python_requires=PYTHON_REQUIRES,
@@ -45,12 +45,16 @@ setup(name='ipmlab',
       maintainer_email='johan.vanderknijff@kb.nl',
       url='https://github.com/KBNLresearch/ipmlab',
       download_url=('https://github.com/KBNLresearch/ipmlab/archive/' +
-                    find_version('ipmlab', 'ipmlab.py') + '.tar.gz'),
+                    find_version('ipmlab', '__init__.py') + '.tar.gz'),
       package_data={'ipmlab': ['*.*', 'conf/*.*', 'icons/*.*']},
       zip_safe=False,
       entry_points={'gui_scripts': [
           'ipmlab = ipmlab.ipmlab:main',
           'ipmlab-configure = ipmlab.configure:main',
+      ],
+          'console_scripts': [
+          'ipmlab-resolve = ipmlab.picklist:main',
+          'ipmlab-headless = ipmlab.headless:main',
       ]},
       classifiers=[
           'Programming Language :: Python :: 3',]